@@ -0,0 +1,252 @@
+"""
+Benchmarks of the CNNeuro-DS-Generator on a synthetic, IXI-like corpus (see synthetic.py).
+Times the single stages of a transformation (load, roi_mask, gaussian_blur / blur_mask, concat, lesion loop, save) and
+whole generate_dataset runs at several worker counts and writes the results to a JSON file, e.g.
+
+> python benchmarks/run_benchmarks.py --output bench-new.json --compare bench-old.json
+"""
+import os
+import sys
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # the checkout, no install needed
+from synthetic import build_corpus
+from cnneuro_ds_generator.dataset import generate_dataset
+from cnneuro_ds_generator.utils import mask as mask_module, transform
+from cnneuro_ds_generator.utils.atlas import clear_atlas_cache, label_geometry, label_index, load_atlas
+from cnneuro_ds_generator.utils.files import save_nifti
+from cnneuro_ds_generator.utils.mask import atrophy_basis, basis_mask, blur_mask, concat, label_bases, roi_mask, \
+    sum_bases
+from cnneuro_ds_generator.utils.mri import Volume, gaussian_blur
+from cnneuro_ds_generator.utils.subjects import scan_subjects
+import argparse
+import cnneuro_ds_generator
+import contextlib
+import json
+import multiprocessing
+import nibabel as nib
+import numpy as np
+import platform
+import scipy
+import shutil
+import statistics
+import tempfile
+import time
+
+RESULTS_VERSION = 1
+ROI = [3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 19, 20]  # the frontal regions of the example
+SMALL_ROI = [41]  # a single region, e.g. the left hippocampus
+SCENARIOS = ('atrophy', 'atrophy_loc_max', 'lesion')
+
+
+def __summary(seconds):
+    return {'repeats': len(seconds), 'min': min(seconds), 'median': statistics.median(seconds),
+            'mean': statistics.mean(seconds), 'seconds': seconds}
+
+
+def __time(func, repeats, setup=None):
+    """
+    Time func repeats times
+    :param function func: function that is timed, gets the result of setup
+    :param function/None setup: function that is called (untimed) before every call of func with the repeat index
+    :return: summary of the measured seconds
+    """
+    seconds = []
+    for repeat in range(repeats):
+        arg = setup(repeat) if setup is not None else None
+        start = time.perf_counter()
+        func(arg)
+        seconds.append(time.perf_counter() - start)
+    return __summary(seconds)
+
+
+def bench_stages(corpus, repeats, sigma, lesion_size, work_dir):
+    """
+    Time the stages of a transformation on the subjects of the corpus
+    :return: dict that maps the stage names to the summaries of their timings
+    """
+    files = [file for subject_id, file in scan_subjects(corpus['input_dir'])]
+    atlas = corpus['atlas']
+    volume = Volume(files[0])
+    mask = roi_mask(loc=ROI, val=.5, atlas_file=atlas)
+    blurred = gaussian_blur(data_arr=mask, sigma=sigma)
+    patch = blur_mask(mask=roi_mask(loc=ROI, val=.5, atlas_file=atlas, sparse=True), sigma=sigma)
+    small_mask = roi_mask(loc=SMALL_ROI, val=.5, atlas_file=atlas)
+    small_patch = blur_mask(mask=roi_mask(loc=SMALL_ROI, val=.5, atlas_file=atlas, sparse=True), sigma=sigma)
+    basis = atrophy_basis(loc=ROI, atlas_file=atlas, smoothing_sigma=sigma)
+    bases = label_bases(labels=ROI, atlas_file=atlas, smoothing_sigma=sigma)
+    nifti = volume.create_nifti(concat(volume.data, blurred))
+    start = volume.mid_pos()
+    size = (lesion_size, lesion_size, lesion_size)
+    lesion_vectorized = getattr(transform, '__lesion_vectorized')
+    lesion_legacy = getattr(transform, '__lesion_legacy')
+    build_lut_mask = getattr(mask_module, '__lut_mask').__wrapped__  # uncached
+    factors = tuple([(label, .3 + .05 * position) for position, label in enumerate(ROI)])  # a factor per region
+
+    def load_atlas_cold(arg):
+        clear_atlas_cache()
+        load_atlas(atlas).data
+
+    stages = {
+        'load': __time(lambda file: Volume(file).data, repeats, setup=lambda repeat: files[repeat % len(files)]),
+        'load_atlas': __time(load_atlas_cold, repeats),
+        'label_index': __time(lambda arg: label_index(atlas), repeats, setup=lambda repeat: clear_atlas_cache()),
+        'label_geometry': __time(lambda arg: label_geometry(atlas), repeats, setup=lambda repeat: clear_atlas_cache()),
+        'roi_mask': __time(lambda arg: roi_mask(loc=ROI, val=.5, atlas_file=atlas), repeats),
+        'roi_mask_sparse': __time(lambda arg: roi_mask(loc=ROI, val=.5, atlas_file=atlas, sparse=True), repeats),
+        'roi_mask_small': __time(lambda arg: roi_mask(loc=SMALL_ROI, val=.5, atlas_file=atlas, sparse=True), repeats),
+        'gaussian_blur': __time(lambda arg: gaussian_blur(data_arr=mask, sigma=sigma), repeats),
+        'blur_mask': __time(lambda arg: blur_mask(mask=mask, sigma=sigma), repeats),
+        'blur_mask_small': __time(lambda arg: blur_mask(mask=small_mask, sigma=sigma), repeats),
+        'basis_mask': __time(lambda arg: basis_mask(basis=basis, val=.5, smoothing_sigma=sigma), repeats),
+        'sum_bases': __time(lambda arg: sum_bases(bases=bases, loc=ROI[::2]), repeats),
+        'lut_mask': __time(lambda arg: build_lut_mask(os.path.abspath(atlas), None, factors, False, 'float64', True),
+                           repeats),
+        'concat': __time(lambda arg: concat(volume.data, blurred), repeats),
+        'concat_patch': __time(lambda data: concat(data, patch, out=data), repeats,
+                               setup=lambda repeat: volume.data.copy()),
+        'concat_patch_small': __time(lambda data: concat(data, small_patch, out=data), repeats,
+                                     setup=lambda repeat: volume.data.copy()),
+        'lesion_vectorized': __time(
+            lambda data: lesion_vectorized(mri_data=data, start=start, size=size, change_prob=.5,
+                                           intensity=(.5, 1.), seed=42),
+            repeats, setup=lambda repeat: volume.data.copy()),
+        'lesion_legacy': __time(
+            lambda data: lesion_legacy(mri_data=data, start=start, size=size, change_prob=.5, intensity=(.5, 1.),
+                                       seed=42),
+            repeats, setup=lambda repeat: volume.data.copy()),
+    }
+    for output_format in ('nii', 'nii.gz'):
+        path = os.path.join(work_dir, 'stage.' + output_format)
+        stages['save_' + output_format.replace('.', '_')] = __time(lambda arg: save_nifti(nifti, path), repeats)
+    clear_atlas_cache()
+    return stages
+
+
+def __scenario_settings(scenario, corpus, sigma, lesion_size):
+    if scenario == 'atrophy':
+        return transform.atrophy, {'loc': ROI, 'atrophy_val': .5, 'atlas': corpus['atlas'],
+                                   'smoothing_sigma': sigma}
+    if scenario == 'atrophy_loc_max':  # a different mask for every subject
+        return transform.atrophy, {'loc': ROI, 'loc_max': len(ROI), 'atrophy_val': (.3, .7),
+                                   'atlas': corpus['atlas'], 'smoothing_sigma': sigma}
+    return transform.lesion, {'change_prob': .5, 'intensity': (.5, 1.), 'size': (lesion_size, lesion_size, lesion_size),
+                              'pos_offset': ((-5, -5, -5), (5, 5, 5))}  # around the mid, regions can lie at the border
+
+
+def __timed_run(connection, kwargs):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        generate_dataset(**kwargs)
+        connection.send(time.perf_counter() - start)
+    connection.close()
+
+
+def bench_runs(corpus, scenarios, workers_list, repeats, sigma, lesion_size, work_dir):
+    """
+    Time whole generate_dataset runs. Every run takes place in a fresh process, so no cache of an earlier run (e.g.
+    the atlas or a mask) is warm.
+    :return: list of dicts with the scenario, the amount of workers and the summary of the timings
+    """
+    context = multiprocessing.get_context('spawn')
+    amount_ill = corpus['amount_subs'] // 2
+    runs = []
+    for scenario in scenarios:
+        transformer, transformer_settings = __scenario_settings(scenario, corpus, sigma, lesion_size)
+        for workers in workers_list:
+            seconds = []
+            for repeat in range(repeats):
+                output_dir = os.path.join(work_dir, 'run')
+                shutil.rmtree(output_dir, ignore_errors=True)
+                kwargs = {'input_dir': corpus['input_dir'], 'output_dir': output_dir,
+                          'amount_healthy_subs': corpus['amount_subs'] - amount_ill, 'amount_ill_subs': amount_ill,
+                          'transformer': transformer, 'transformer_settings': transformer_settings, 'seed': 42,
+                          'workers': workers}
+                receiver, sender = context.Pipe(duplex=False)
+                process = context.Process(target=__timed_run, args=(sender, kwargs))
+                process.start()
+                sender.close()
+                try:
+                    seconds.append(receiver.recv())
+                except EOFError:
+                    raise RuntimeError('The %s run with %d workers failed!' % (scenario, workers))
+                finally:
+                    process.join()
+            summary = __summary(seconds)
+            runs.append(dict({'scenario': scenario, 'workers': workers,
+                              'subjects_per_second': corpus['amount_subs'] / summary['median']}, **summary))
+            print('%-16s workers=%-3d %8.3f s' % (scenario, workers, summary['median']))
+    return runs
+
+
+def environment():
+    return {'cnneuro_ds_generator': cnneuro_ds_generator.__version__, 'python': platform.python_version(),
+            'numpy': np.__version__, 'scipy': scipy.__version__, 'nibabel': nib.__version__,
+            'platform': platform.platform(), 'cpu_count': os.cpu_count()}
+
+
+def compare(results, baseline):
+    """ Print the median timings of results relative to the ones of an earlier results file """
+    print('\nrelative to', baseline['environment']['cnneuro_ds_generator'], '(new / old median):')
+    for name, stage in results['stages'].items():
+        if name in baseline.get('stages', {}):
+            print('%-30s %6.2fx' % (name, stage['median'] / baseline['stages'][name]['median']))
+    old_runs = {(run['scenario'], run['workers']): run for run in baseline.get('runs', [])}
+    for run in results['runs']:
+        old_run = old_runs.get((run['scenario'], run['workers']))
+        if old_run is not None:
+            print('%-30s %6.2fx' % ('%s (workers=%d)' % (run['scenario'], run['workers']),
+                                    run['median'] / old_run['median']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the CNNeuro-DS-Generator on a synthetic corpus')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file for the results')
+    parser.add_argument('--corpus-dir', default=None,
+                        help='directory of the synthetic corpus (reused between runs). Default: temporary directory')
+    parser.add_argument('--subjects', type=int, default=8, help='amount of subjects of the corpus')
+    parser.add_argument('--scale', type=float, default=1.,
+                        help='edge length of the volumes relative to the IXI grey matter maps (121 x 145 x 121)')
+    parser.add_argument('--labels', type=int, default=170, help='amount of regions of the atlas')
+    parser.add_argument('--repeats', type=int, default=5, help='repeats of every stage')
+    parser.add_argument('--run-repeats', type=int, default=1, help='repeats of every whole run')
+    parser.add_argument('--workers', default='1,2,4', help='comma separated worker counts of the whole runs')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='comma separated scenarios of the whole runs (%s)' % ', '.join(SCENARIOS))
+    parser.add_argument('--sigma', type=float, default=3.4, help='smoothing sigma of the atrophy masks')
+    parser.add_argument('--lesion-size', type=int, default=10, help='edge length of the lesions')
+    parser.add_argument('--skip-stages', action='store_true', help='only time whole runs')
+    parser.add_argument('--skip-runs', action='store_true', help='only time the stages')
+    parser.add_argument('--compare', default=None, help='results file of an earlier version to compare with')
+    args = parser.parse_args(argv)
+
+    scenarios = [scenario for scenario in args.scenarios.split(',') if scenario]
+    if any([scenario not in SCENARIOS for scenario in scenarios]):
+        parser.error('scenarios must be some of %s' % ', '.join(SCENARIOS))
+    workers_list = [int(workers) for workers in args.workers.split(',') if workers]
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        corpus_dir = args.corpus_dir if args.corpus_dir is not None else os.path.join(work_dir, 'corpus')
+        corpus = build_corpus(corpus_dir, amount_subs=args.subjects, scale=args.scale, amount_labels=args.labels)
+        results = {'version': RESULTS_VERSION, 'environment': environment(),
+                   'corpus': {key: corpus[key] for key in ('amount_subs', 'shape', 'voxel_size', 'amount_labels',
+                                                           'seed')},
+                   'settings': {'sigma': args.sigma, 'lesion_size': args.lesion_size, 'roi': ROI,
+                                'small_roi': SMALL_ROI},
+                   'stages': {}, 'runs': []}
+        if not args.skip_stages:
+            results['stages'] = bench_stages(corpus, args.repeats, args.sigma, args.lesion_size, work_dir)
+            for name, stage in results['stages'].items():
+                print('%-30s %8.4f s' % (name, stage['median']))
+        if not args.skip_runs:
+            results['runs'] = bench_runs(corpus, scenarios, workers_list, args.run_repeats, args.sigma,
+                                         args.lesion_size, work_dir)
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    if args.compare is not None:
+        with open(args.compare, 'r') as file:
+            compare(results, json.load(file))
+    return results
+
+
+if __name__ == '__main__':
+    main()
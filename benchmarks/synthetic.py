@@ -0,0 +1,101 @@
+"""
+Synthetic, IXI-like corpus for the benchmarks: grey matter maps that are shaped like the CAT12 outputs of the IXI
+dataset (mwp1IXI<id>-<site>-<number>-T1.nii, 121 x 145 x 121 voxels at 1.5 mm) and an AAL-like label atlas on the same
+grid. Everything is generated offline from a seed, no download is needed.
+"""
+from scipy.ndimage import gaussian_filter
+from scipy.spatial import cKDTree
+import json
+import nibabel as nib
+import numpy as np
+import os
+import shutil
+
+IXI_SHAPE = (121, 145, 121)
+IXI_VOXEL_SIZE = 1.5
+IXI_SITES = ('Guys', 'HH', 'IOP')
+CORPUS_FILE = 'corpus.json'
+
+
+def corpus_shape(scale):
+    """
+    :param float scale: edge length relative to the IXI grey matter maps
+    :return: shape of the volumes
+    """
+    return tuple([max(8, int(round(edge * scale))) for edge in IXI_SHAPE])
+
+
+def __affine(shape, voxel_size):
+    affine = np.diag([-voxel_size, voxel_size, voxel_size, 1.])
+    affine[:3, 3] = [voxel_size * (shape[0] - 1) / 2, -voxel_size * (shape[1] - 1) / 2,
+                     -voxel_size * (shape[2] - 1) / 2]
+    return affine
+
+
+def __brain(shape):
+    """ Ellipsoid that fills most of the field of view """
+    grid = np.ogrid[tuple([slice(0, edge) for edge in shape])]
+    dist = sum([((axis - (edge - 1) / 2) / (edge * .42)) ** 2 for axis, edge in zip(grid, shape)])
+    return dist <= 1
+
+
+def __atlas_data(brain, amount_labels, rng):
+    """ Voronoi parcellation of the brain into amount_labels regions with the labels 1, ..., amount_labels """
+    coords = np.argwhere(brain)
+    seeds = coords[rng.choice(len(coords), size=amount_labels, replace=False)]
+    _, nearest = cKDTree(seeds).query(coords)
+    labels = np.zeros(brain.shape, dtype=np.int16)
+    labels[tuple(coords.T)] = nearest + 1
+    return labels
+
+
+def __subject_data(brain, rng, voxel_size):
+    """ Smooth random field in [0, 1] inside of the brain, like a modulated grey matter map """
+    data = gaussian_filter(rng.random(brain.shape, dtype=np.float32), sigma=3 / voxel_size)
+    data -= data[brain].min()
+    data /= data[brain].max()
+    data[~brain] = 0
+    return data
+
+
+def build_corpus(corpus_dir, amount_subs=8, scale=1., amount_labels=170, seed=42):
+    """
+    Build the synthetic corpus in corpus_dir (reused if it already exists with the same parameters):
+    corpus_dir/IXI-GM/<site>/mwp1IXI<id>-<site>-<number>-T1.nii and corpus_dir/atlas/atlas.nii.gz
+    :param str corpus_dir: directory of the corpus
+    :param int amount_subs: amount of subjects
+    :param float scale: edge length of the volumes relative to the IXI grey matter maps
+    :param int amount_labels: amount of regions of the atlas (AAL3 has 170)
+    :param int seed: RNG seed
+    :return: dict with the parameters of the corpus and the paths of the input directory and the atlas
+    """
+    shape = corpus_shape(scale)
+    voxel_size = IXI_VOXEL_SIZE / scale
+    corpus = {'amount_subs': amount_subs, 'shape': list(shape), 'voxel_size': voxel_size,
+              'amount_labels': amount_labels, 'seed': seed}
+    input_dir = os.path.join(corpus_dir, 'IXI-GM')
+    atlas_file = os.path.join(corpus_dir, 'atlas', 'atlas.nii.gz')
+    paths = {'input_dir': os.path.abspath(input_dir), 'atlas': os.path.abspath(atlas_file)}
+
+    try:
+        with open(os.path.join(corpus_dir, CORPUS_FILE), 'r') as file:
+            if json.load(file) == corpus:
+                return dict(corpus, **paths)
+    except (OSError, ValueError):
+        pass
+
+    shutil.rmtree(input_dir, ignore_errors=True)  # leftovers of a corpus with other parameters
+    rng = np.random.default_rng(seed)
+    affine = __affine(shape, voxel_size)
+    brain = __brain(shape)
+    os.makedirs(os.path.dirname(atlas_file), exist_ok=True)
+    nib.save(nib.Nifti1Image(__atlas_data(brain, amount_labels, rng), affine), atlas_file)
+    for index in range(amount_subs):
+        site = IXI_SITES[index % len(IXI_SITES)]
+        sub_dir = os.path.join(input_dir, site)
+        os.makedirs(sub_dir, exist_ok=True)
+        name = 'mwp1IXI%03d-%s-%04d-T1.nii' % (index + 2, site, 1000 + index)  # the IXI ids start at 002
+        nib.save(nib.Nifti1Image(__subject_data(brain, rng, voxel_size), affine), os.path.join(sub_dir, name))
+    with open(os.path.join(corpus_dir, CORPUS_FILE), 'w') as file:
+        json.dump(corpus, file)
+    return dict(corpus, **paths)
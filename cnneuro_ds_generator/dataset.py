@@ -1,21 +1,28 @@
+import collections
+import concurrent.futures
 import functools
-import glob
+import json
 import random
 import os
-import shutil
+import tempfile
 import nibabel as nib
+import numpy as np
 import pandas as pd
 import cnneuro_ds_generator
+from cnneuro_ds_generator.utils.files import LINK_MODES, OUTPUT_FORMATS, file_sha256, link_file, remove_file, \
+    save_nifti, temp_path, transcode_file
+from cnneuro_ds_generator.utils.manifest import append_manifest, canonicalize, file_fingerprint, load_manifest, \
+    output_matches, write_manifest
+from cnneuro_ds_generator.utils.mask import atrophy_mask, concat
+from cnneuro_ds_generator.utils.mri import Volume
+from cnneuro_ds_generator.utils.store import SubjectStore
+from cnneuro_ds_generator.utils.subjects import get_ixi_id, scan_subjects
+from cnneuro_ds_generator.utils.trace import Progress, Trace, record, run_traced, span
+from cnneuro_ds_generator.utils.transform import lesion
 
-def get_ixi_id(ixi_file):
-    """ Takes path to ixi subject and returns a string containing the ixi id """
-    return ixi_file.split('/')[-1].split('IXI')[-1][0:3]
-
-
-def __gather_subs(input_dir, amount_ill_patients, amount_healthy_patients, shuffle, seed):
-    patients = glob.glob(input_dir + '/**/*.nii', recursive=True)
-    patients.extend(glob.glob(input_dir + '/**/*.nii.gz', recursive=True))
-    patients = sorted(patients, key=lambda file: int(get_ixi_id(file)))
+def __gather_subs(input_dir, amount_ill_patients, amount_healthy_patients, shuffle, seed, index_cache=None):
+    with span('scan', file=input_dir):
+        patients = [file for subject_id, file in scan_subjects(input_dir, cache_file=index_cache)]
 
     print('Found', len(patients), 'nifti files.')
     if amount_ill_patients > len(patients):
@@ -30,16 +37,40 @@ def __gather_subs(input_dir, amount_ill_patients, amount_healthy_patients, shuff
     return ill_patients, healthy_patients
 
 
-def __save_sub(mri_file, subject_id, output_dir, ill):
+def __output_name(subject_id, ill, output_format):
+    return 'sub-' + subject_id + ('-ill.' if ill else '-healthy.') + output_format
+
+
+def __save_sub(mri_file, subject_id, output_dir, ill, healthy_mode='copy', output_format='nii', compression_level=6,
+               compression_threads=None):
     if not os.path.isdir(output_dir):
         os.makedirs(output_dir)
 
-    if ill:
-        dest = os.path.join(output_dir, 'sub-' + subject_id + '-ill.nii')
-        nib.save(mri_file, dest)
+    sha256 = None  # only known if the content passed through memory
+    dest = os.path.join(output_dir, __output_name(subject_id, ill, output_format))
+    if ill and not isinstance(mri_file, str):
+        sha256 = save_nifti(mri_file, dest, compression_level=compression_level, threads=compression_threads)
+    elif ill:  # uncompressed file the transformer has streamed its result into
+        if dest.endswith('.gz'):
+            sha256 = transcode_file(src=mri_file, dest=dest, compression_level=compression_level,
+                                    threads=compression_threads)
+        else:
+            os.replace(mri_file, dest)
     else:
-        dest = os.path.join(output_dir, 'sub-' + subject_id + '-healthy.nii')
-        shutil.copy(mri_file, dest)
+        if mri_file.endswith('.gz') == dest.endswith('.gz'):
+            link_file(src=mri_file, dest=dest, mode=healthy_mode)
+        else:
+            sha256 = transcode_file(src=mri_file, dest=dest, compression_level=compression_level,
+                                    threads=compression_threads)
+    return dest, sha256
+
+
+def __output_record(dest, sha256):
+    stat = os.stat(dest)
+    if sha256 is None:
+        with span('hash', file=dest, bytes_read=stat.st_size):
+            sha256 = file_sha256(dest)
+    return {'sha256': sha256, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
 
 
 def __generate_tumor_demographic(output_dir, ill_subs, healthy_subs):
@@ -60,33 +91,580 @@ def __generate_tumor_demographic(output_dir, ill_subs, healthy_subs):
     df.to_csv(os.path.join(output_dir, 'demographic.csv'))
 
 
+def __write_dataset_info(output_dir, ill_subs, healthy_subs):
+    __generate_tumor_demographic(output_dir=output_dir, ill_subs=ill_subs, healthy_subs=healthy_subs)
+    version_file = os.path.join(output_dir, 'version.txt')
+    version = cnneuro_ds_generator.__version__
+    with open(version_file, 'w') as file:
+        file.write('This dataset was created with version %s of the CNNeuro-DS-Generator.' % version)
+
+
+def __create_stack(output_dir, subs, stack_dtype):
+    """
+    Preallocate the stacked dataset subjects.npy with one row per subject and write its index (index.csv), the affine
+    (affine.npy) and the nifti header (header.bin, read it with nibabel.Nifti1Header.from_fileobj) of the subjects.
+    """
+    if len(subs) == 0:
+        raise ValueError('A stacked dataset needs at least one subject!')
+    reference = nib.load(subs[0])
+    stack_file = os.path.join(output_dir, 'subjects.npy')
+    stack = np.lib.format.open_memmap(stack_file, mode='w+', dtype=stack_dtype, shape=(len(subs),) + reference.shape)
+    del stack  # the rows are written by the jobs
+
+    np.save(os.path.join(output_dir, 'affine.npy'), reference.affine)
+    header = reference.header.copy()
+    header.set_data_dtype(stack_dtype)
+    header.set_slope_inter(1, 0)
+    with open(os.path.join(output_dir, 'header.bin'), 'wb') as file:
+        file.write(header.binaryblock)
+    return stack_file
+
+
+def __write_stack_index(output_dir, ill_subs, healthy_subs):
+    subs = ill_subs + healthy_subs
+    data = {'row': list(range(len(subs))), 'id': [get_ixi_id(sub) for sub in subs],
+            'ill': [1] * len(ill_subs) + [0] * len(healthy_subs)}
+    df = pd.DataFrame(data, columns=['row', 'id', 'ill'])
+    df.to_csv(os.path.join(output_dir, 'index.csv'), index=False)
+
+
+def __stack_sub(stack_file, row, transformer, transformer_settings, sub, seed, ill):
+    with span('subject', subject=get_ixi_id(sub), ill=ill):
+        nifti = __produce_sub(transformer=transformer, transformer_settings=transformer_settings, sub=sub, seed=seed,
+                              ill=ill, as_array=False, dtype=None)
+        with span('load', file=sub, bytes_read=0 if ill else os.path.getsize(sub)):  # ill subjects are in memory
+            data = np.asanyarray(nifti.dataobj)
+        with span('save', file=stack_file) as event:
+            stack = np.load(stack_file, mmap_mode='r+')
+            if data.shape != stack.shape[1:]:
+                raise ValueError('Every subject of a stacked dataset must have the shape %s, %s has the shape %s!'
+                                 % (stack.shape[1:], sub, data.shape))
+            stack[row] = data
+            stack.flush()
+            event['bytes_written'] = stack[row].nbytes
+
+
+def __check_options(workers, save_settings):
+    if workers is not None and (not isinstance(workers, int) or workers < 1):
+        raise ValueError('workers must be None or an int greater than 0!')
+    if save_settings['healthy_mode'] not in LINK_MODES:
+        raise ValueError('healthy_mode must be one of %s!' % ', '.join(LINK_MODES))
+    if save_settings['output_format'] not in OUTPUT_FORMATS:
+        raise ValueError('output_format must be one of %s!' % ', '.join(OUTPUT_FORMATS))
+    if not isinstance(save_settings['compression_level'], int) or not 0 <= save_settings['compression_level'] <= 9:
+        raise ValueError('compression_level must be an int between 0 and 9!')
+    threads = save_settings['compression_threads']
+    if threads is not None and (not isinstance(threads, int) or threads < 1):
+        raise ValueError('compression_threads must be None or an int greater than 0!')
+
+
+def __compression_threads(compression_threads, workers):
+    """ compression threads per process: None shares the CPUs between the worker processes """
+    if compression_threads is not None or workers is None or workers == 1:
+        return compression_threads  # None -> one thread per CPU in the current process
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+def __transform_sub(transformer, transformer_settings, ill_sub, seed, output_dir, save_settings, store=None):
+    with span('subject', subject=get_ixi_id(ill_sub), ill=True):
+        output_format = save_settings['output_format']
+        if store is not None:  # materialise the subject from the store if it was already computed
+            key = store.key(input_file=ill_sub, transformer=transformer, transformer_settings=transformer_settings,
+                            seed=seed, output_format=output_format,
+                            compression_level=save_settings['compression_level'])
+            dest = os.path.join(output_dir, __output_name(get_ixi_id(ill_sub), True, output_format))
+            sha256 = store.get(key=key, output_format=output_format, dest=dest)
+            if sha256 is not None:
+                return dict(__output_record(dest, sha256), store_bytes=0)
+
+        transformer_func = functools.partial(transformer, **transformer_settings)
+        if transformer_settings.get('memory_budget') is not None:  # the result is streamed into a file, see atrophy
+            os.makedirs(output_dir, exist_ok=True)
+            out_file = temp_path(os.path.join(output_dir, __output_name(get_ixi_id(ill_sub), True, 'nii'))) + '.nii'
+            try:
+                transformer_func(mri_file=ill_sub, seed=seed, out_file=out_file)
+                dest, sha256 = __save_sub(mri_file=out_file, subject_id=get_ixi_id(ill_sub), output_dir=output_dir,
+                                          ill=True, **save_settings)
+            finally:
+                remove_file(out_file)
+        else:
+            new_mri = transformer_func(mri_file=ill_sub, seed=seed)
+            dest, sha256 = __save_sub(mri_file=new_mri, subject_id=get_ixi_id(ill_sub), output_dir=output_dir,
+                                      ill=True, **save_settings)
+        store_bytes = 0
+        if store is not None:
+            store_bytes = store.put(key=key, output_format=output_format, src=dest, sha256=sha256)
+        return dict(__output_record(dest, sha256), store_bytes=store_bytes)
+
+
+def __healthy_sub(healthy_sub, output_dir, save_settings):
+    with span('subject', subject=get_ixi_id(healthy_sub), ill=False):
+        dest, sha256 = __save_sub(mri_file=healthy_sub, subject_id=get_ixi_id(healthy_sub), output_dir=output_dir,
+                                  ill=False, **save_settings)
+        if sha256 is None:  # linked, the output has the content of its source -> no need to read it
+            stat = os.stat(dest)
+            return {'source': file_fingerprint(healthy_sub), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        return __output_record(dest, sha256)
+
+
+def __manifest_entry(sub, ill, transformer, transformer_settings, seed, save_settings):
+    entry = {'input': file_fingerprint(sub), 'ill': ill, 'transformer': None, 'settings': None, 'seed': None,
+             'output_format': save_settings['output_format'], 'compression_level': save_settings['compression_level']}
+    if ill:
+        entry.update({'transformer': canonicalize(transformer), 'settings': canonicalize(transformer_settings),
+                      'seed': seed})
+    else:
+        entry['healthy_mode'] = save_settings['healthy_mode']
+    return json.loads(json.dumps(entry))  # same representation as an entry that was read from the manifest
+
+
+def __unwrap(transformer, transformer_settings):
+    """
+    :return: function behind (nested) functools.partial objects and the keyword arguments it gets called with
+    """
+    keywords = dict(transformer_settings)
+    while isinstance(transformer, functools.partial):
+        keywords = dict(transformer.keywords, **keywords)  # the outer arguments override the inner ones
+        transformer = transformer.func
+    return transformer, keywords
+
+
+def __ill_settings(transformer, transformer_settings, amount_ill_subs, seed):
+    """
+    Transformer settings of every ill subject. They are the same for every subject, except for lesion with
+    engine='legacy' and a list of locations: earlier versions shuffled that list in place, so every subject started
+    from the order the previous subject left behind. This chain of orders is computed here, in subject order, so the
+    legacy output is reproduced no matter in which process or order the subjects are generated.
+    :return: list with the settings of the n-th ill subject at index n
+    """
+    func, keywords = __unwrap(transformer, transformer_settings)
+    loc = keywords.get('loc')
+    if keywords.get('engine') != 'legacy' or not isinstance(loc, list) or len(loc) < 2:
+        return [transformer_settings] * amount_ill_subs
+    if func is not lesion:
+        raise ValueError("The order of the locations of engine='legacy' can only be reproduced for lesion (or a "
+                         "functools.partial of it)!")
+    settings = []
+    for index in range(amount_ill_subs):
+        settings.append(dict(transformer_settings, loc=loc))
+        loc = loc.copy()
+        np.random.RandomState(seed + index).shuffle(loc)  # the shuffle of lesion, applied to its copy of loc
+    return settings
+
+
+def __plan_nifti_jobs(output_dir, ill_subs, healthy_subs, transformer, transformer_settings, seed, save_settings,
+                      resume, store):
+    """
+    Create the jobs of the nifti backend. If resume is True, subjects whose manifest entry matches the current
+    settings and whose output file is unchanged are skipped, and outputs of subjects that are no longer part of the
+    dataset are removed.
+    :return: jobs, the output file names of the jobs, the (new) manifest entries of the jobs and the manifest entries of
+             the skipped subjects
+    """
+    manifest = load_manifest(output_dir) if resume else {}
+    ill_settings = __ill_settings(transformer, transformer_settings, len(ill_subs), seed)
+    jobs, names, entries, done = [], [], {}, {}
+    for index, sub in enumerate(ill_subs + healthy_subs):
+        ill = index < len(ill_subs)
+        name = __output_name(get_ixi_id(sub), ill, save_settings['output_format'])
+        sub_settings = ill_settings[index] if ill else transformer_settings
+        entry = __manifest_entry(sub=sub, ill=ill, transformer=transformer, transformer_settings=sub_settings,
+                                 seed=seed + index, save_settings=save_settings)
+        old_entry = manifest.get(name)
+        if old_entry is not None and dict(old_entry, output=None) == dict(entry, output=None) and \
+                output_matches(output_dir, name, old_entry):
+            done[name] = old_entry
+            continue
+        if ill:
+            jobs.append((__transform_sub, {'transformer': transformer, 'transformer_settings': sub_settings,
+                                           'ill_sub': sub, 'seed': seed + index, 'output_dir': output_dir,
+                                           'save_settings': save_settings, 'store': store}))
+        else:
+            jobs.append((__healthy_sub, {'healthy_sub': sub, 'output_dir': output_dir,
+                                         'save_settings': save_settings}))
+        names.append(name)
+        entries[name] = entry
+
+    for name in manifest:
+        if name not in done and name not in entries:  # the subject is not part of the dataset anymore
+            remove_file(os.path.join(output_dir, name))
+    return jobs, names, entries, done
+
+
+def __run_jobs(jobs, workers, trace=None, progress=None):
+    """
+    Run (func, kwargs) jobs either one after another or spread over a pool of worker processes.
+    :param list jobs: list of (func, kwargs) tuples
+    :param int/None workers: number of worker processes. None or 1 runs every job in the current process.
+    :param utils.trace.Trace/None trace: if set, the spans of the jobs (also the ones of the worker processes) are
+                                         recorded into it
+    :param utils.trace.Progress/None progress: gets updated after every job, only used if trace is set
+    :return: generator of (index of the job, result of the job) tuples in the order in which the jobs finish. If a job
+             fails, the jobs that did not start yet are cancelled and the exception is raised after the results of the
+             running jobs were yielded.
+    """
+    if trace is not None:
+        jobs = [(run_traced, {'func': func, 'kwargs': kwargs}) for func, kwargs in jobs]
+    for index, result in __run_job_pool(jobs=jobs, workers=workers):
+        if trace is not None:
+            result, events = result
+            trace.events.extend(events)
+            if progress is not None:
+                progress.update(events)
+        yield index, result
+
+
+def __run_job_pool(jobs, workers):
+    if workers is None or workers == 1:
+        for index, (func, kwargs) in enumerate(jobs):
+            yield index, func(**kwargs)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(func, **kwargs): index for index, (func, kwargs) in enumerate(jobs)}
+        error = None
+        for future in concurrent.futures.as_completed(futures):
+            if future.cancelled():
+                continue
+            if future.exception() is not None:
+                if error is None:
+                    error = future.exception()
+                    for pending in futures:
+                        pending.cancel()
+                continue
+            yield futures[future], future.result()
+        if error is not None:
+            raise error  # re-raise exceptions of the workers
+
+
 def generate_dataset(input_dir, output_dir, amount_healthy_subs, amount_ill_subs, transformer, transformer_settings,
-                     seed, shuffle_subjects=False):
+                     seed, shuffle_subjects=False, workers=None, healthy_mode='copy', output_format='nii',
+                     compression_level=6, compression_threads=None, output_backend='nifti', stack_dtype=np.float32,
+                     resume=False, store_dir=None, store_limit=None, index_cache=None, trace=None, progress=None):
+    """
+    Generate a dataset with amount_ill_subs transformed and amount_healthy_subs untouched subjects.
+    :param str input_dir: directory that contains the source subjects
+    :param str output_dir: directory where the dataset will be stored
+    :param int amount_healthy_subs: amount of healthy subjects
+    :param int amount_ill_subs: amount of ill subjects
+    :param function transformer: transformer (e.g. atrophy or lesion) that is applied to the ill subjects
+    :param dict transformer_settings: settings that are passed to the transformer. If it contains a memory_budget
+                                      (see utils.transform.atrophy), the transformer streams every ill subject into
+                                      a file that is moved (or compressed) to output_dir, which is only supported by
+                                      the 'nifti' backend.
+    :param int seed: RNG seed. The n-th ill subject gets transformed with seed + n.
+    :param bool shuffle_subjects: if True, the subjects get shuffled before they are split into ill and healthy
+    :param int/None workers: number of worker processes. None or 1 processes every subject in the current process.
+                             The transformer has to be picklable (e.g. a module-level function) when workers > 1.
+                             The generated files are the same for every amount of workers.
+    :param str healthy_mode: how the healthy subjects are placed in output_dir: 'copy', 'hardlink', 'reflink' or
+                             'symlink'. If the filesystem does not support the mode, the subjects get copied.
+                             Healthy subjects that are stored in the other output_format get (de)compressed instead.
+    :param str output_format: 'nii' or 'nii.gz'
+    :param int compression_level: gzip compression level (0-9) of 'nii.gz' outputs
+    :param int/None compression_threads: maximal amount of threads that compress one volume in parallel. None uses one
+                                         thread per CPU, shared between the worker processes.
+    :param str output_backend: 'nifti' writes one file per subject. 'npy' writes all subjects into the rows of one
+                               memory-mappable (N, X, Y, Z) array subjects.npy (ill subjects first, then the healthy
+                               ones) together with index.csv (row, id, ill), affine.npy and header.bin. The options
+                               healthy_mode, output_format and compression_* only apply to the 'nifti' backend.
+    :param numpy.dtype stack_dtype: dtype of subjects.npy
+    :param bool resume: The 'nifti' backend records the input file, transformer, settings, seed and the checksum of
+                        the output of every subject (the fingerprint of the source for linked healthy subjects) in
+                        output_dir/manifest.json. If resume is True, subjects whose entry matches and whose output file
+                        is unchanged are not generated again (e.g. after a crashed run or to grow a dataset) and outputs
+                        of subjects that are not part of the dataset anymore are removed.
+    :param str/None store_dir: directory of a content-addressed store of transformed subjects (see
+                               utils.store.SubjectStore), only used by the 'nifti' backend. Ill subjects that are
+                               in the store are hardlinked from there instead of being computed, computed subjects
+                               are added to the store.
+    :param int/None store_limit: maximal size of the store in bytes, least recently used subjects are evicted
+    :param str/None index_cache: file in which the list of subjects of input_dir is cached (see
+                                 utils.subjects.scan_subjects). None scans input_dir on every call.
+    :param utils.trace.Trace/None trace: if set, the time of every stage (load, mask, blur, apply, lesion, compress,
+                                         save, ...) of every subject and the bytes that were read and written are
+                                         recorded into it (also in the worker processes). Export it with
+                                         trace.write_jsonl or trace.write_chrome_trace.
+    :param function/None progress: function that gets called with a progress event (a dict with the subject, its
+                                   seconds and bytes, the amount of done subjects, subjects_per_second,
+                                   bytes_per_second, eta, ... see utils.trace.Progress) after every subject
+    :return: run report: dict with the amount of generated and skipped subjects, the seconds of the run,
+             subjects_per_second, bytes_read, bytes_written, bytes_per_second and the totals of every phase (see
+             utils.trace.Progress.report)
+    """
+    save_settings = {'healthy_mode': healthy_mode, 'output_format': output_format,
+                     'compression_level': compression_level, 'compression_threads': compression_threads}
+    __check_options(workers, save_settings)
+    save_settings['compression_threads'] = __compression_threads(compression_threads, workers)
+    if output_backend not in ('nifti', 'npy'):
+        raise ValueError("output_backend must be either 'nifti' or 'npy'!")
+    if resume and output_backend != 'nifti':
+        raise ValueError("resume is only supported by the 'nifti' output_backend!")
+    if transformer_settings.get('memory_budget') is not None and output_backend != 'nifti':
+        raise ValueError("memory_budget is only supported by the 'nifti' output_backend!")
     input_dir = os.path.abspath(input_dir)
     if not os.path.exists(input_dir):
         raise Exception('The specified input_dir %s does not exist!' % input_dir)
     output_dir = os.path.abspath(output_dir)
     os.makedirs(output_dir, exist_ok=True)
+    trace = trace if trace is not None else Trace()  # the run report is based on the trace
+    monitor = Progress(trace, callback=progress)
+
+    with record(trace):
+        ill_subs, healthy_subs = __gather_subs(input_dir=input_dir, amount_ill_patients=amount_ill_subs,
+                                               amount_healthy_patients=amount_healthy_subs, shuffle=shuffle_subjects,
+                                               seed=seed, index_cache=index_cache)
+
+    if output_backend == 'npy':
+        jobs = []
+        stack_file = __create_stack(output_dir=output_dir, subs=ill_subs + healthy_subs, stack_dtype=stack_dtype)
+        ill_settings = __ill_settings(transformer, transformer_settings, len(ill_subs), seed)
+        for row, sub in enumerate(ill_subs + healthy_subs):
+            jobs.append((__stack_sub, {'stack_file': stack_file, 'row': row, 'transformer': transformer,
+                                       'transformer_settings': ill_settings[row] if row < len(ill_subs) else
+                                       transformer_settings, 'sub': sub, 'seed': seed + row,
+                                       'ill': row < len(ill_subs)}))
+        __write_stack_index(output_dir=output_dir, ill_subs=ill_subs, healthy_subs=healthy_subs)
+        monitor.total = len(jobs)
+        skipped = 0
+        for _ in __run_jobs(jobs=jobs, workers=workers, trace=trace, progress=monitor):
+            pass
+    else:
+        store = SubjectStore(store_dir, size_limit=store_limit) if store_dir is not None else None
+        jobs, names, entries, manifest = __plan_nifti_jobs(
+            output_dir=output_dir, ill_subs=ill_subs, healthy_subs=healthy_subs, transformer=transformer,
+            transformer_settings=transformer_settings, seed=seed, save_settings=save_settings, resume=resume,
+            store=store
+        )
+        write_manifest(output_dir, manifest)
+        monitor.total = len(jobs)
+        skipped = len(manifest)
+        for index, output in __run_jobs(jobs=jobs, workers=workers, trace=trace, progress=monitor):
+            store_bytes = output.pop('store_bytes', 0)
+            if store is not None:
+                store.add_size(store_bytes)
+            manifest[names[index]] = dict(entries[names[index]], output=output)
+            append_manifest(output_dir, names[index], manifest[names[index]])  # a crashed run can be resumed
+        write_manifest(output_dir, manifest)
+
+    __write_dataset_info(output_dir=output_dir, ill_subs=ill_subs, healthy_subs=healthy_subs)
+    return monitor.report(skipped=skipped)
+
+
+def __produce_sub(transformer, transformer_settings, sub, seed, ill, as_array, dtype):
+    if ill:
+        transformer_func = functools.partial(transformer, **transformer_settings)
+        nifti = transformer_func(mri_file=sub, seed=seed)
+    else:
+        nifti = nib.load(sub)
+    if as_array:
+        return nifti.get_fdata(dtype=dtype)
+    return nifti
+
+
+def iter_generate(input_dir, amount_healthy_subs, amount_ill_subs, transformer, transformer_settings, seed,
+                  shuffle_subjects=False, as_array=False, dtype=np.float64, prefetch=0, index_cache=None):
+    """
+    Generate the subjects of generate_dataset in memory instead of writing them to disk. The subjects are selected
+    and seeded exactly like in generate_dataset and are yielded in the same order: first the ill, then the healthy
+    subjects.
+    :param str input_dir: directory that contains the source subjects
+    :param int amount_healthy_subs: amount of healthy subjects
+    :param int amount_ill_subs: amount of ill subjects
+    :param function transformer: transformer (e.g. atrophy or lesion) that is applied to the ill subjects
+    :param dict transformer_settings: settings that are passed to the transformer
+    :param int seed: RNG seed. The n-th ill subject gets transformed with seed + n.
+    :param bool shuffle_subjects: if True, the subjects get shuffled before they are split into ill and healthy
+    :param bool as_array: if True, the data arrays are yielded instead of the Nifti1Images
+    :param numpy.dtype dtype: dtype of the yielded arrays, only used if as_array is True
+    :param int prefetch: amount of following subjects that are produced by background processes while the current one
+                         is consumed. 0 produces every subject on demand in the current process. The transformer has
+                         to be picklable (e.g. a module-level function) when prefetch > 0.
+    :param str/None index_cache: file in which the list of subjects of input_dir is cached (see generate_dataset)
+    :return: generator of (subject_id, label, nifti_or_array) tuples, label is 1 for ill and 0 for healthy subjects
+    """
+    if not isinstance(prefetch, int) or prefetch < 0:
+        raise ValueError('prefetch must be an int greater than or equal to 0!')
+    input_dir = os.path.abspath(input_dir)
+    if not os.path.exists(input_dir):
+        raise Exception('The specified input_dir %s does not exist!' % input_dir)
 
     ill_subs, healthy_subs = __gather_subs(input_dir=input_dir, amount_ill_patients=amount_ill_subs,
                                            amount_healthy_patients=amount_healthy_subs, shuffle=shuffle_subjects,
-                                           seed=seed)
+                                           seed=seed, index_cache=index_cache)
 
-    transformer_func = functools.partial(transformer, **transformer_settings)
-    current_seed = seed
-    for ill_sub in ill_subs:
-        transformer_func = functools.partial(transformer_func, **{'mri_file': ill_sub})
-        transformer_func = functools.partial(transformer_func, **{'seed': current_seed})
-        new_mri = transformer_func()
-        current_seed += 1
-        __save_sub(mri_file=new_mri, subject_id=get_ixi_id(ill_sub), output_dir=output_dir, ill=True)
+    jobs = []
+    ill_settings = __ill_settings(transformer, transformer_settings, len(ill_subs), seed)
+    for index, sub in enumerate(ill_subs + healthy_subs):
+        ill = index < len(ill_subs)
+        job = {'transformer': transformer, 'transformer_settings': ill_settings[index] if ill else transformer_settings,
+               'sub': sub, 'seed': seed + index, 'ill': ill, 'as_array': as_array, 'dtype': dtype}
+        jobs.append((get_ixi_id(sub), int(ill), job))
 
-    for healthy_sub in healthy_subs:
-        __save_sub(mri_file=healthy_sub, subject_id=get_ixi_id(healthy_sub), output_dir=output_dir, ill=False)
+    if prefetch == 0:
+        for subject_id, label, job in jobs:
+            yield subject_id, label, __produce_sub(**job)
+        return
 
-    __generate_tumor_demographic(output_dir=output_dir, ill_subs=ill_subs, healthy_subs=healthy_subs)
-    version_file = os.path.join(output_dir, 'version.txt')
-    version = cnneuro_ds_generator.__version__
-    with open(version_file, 'w') as file:
-        file.write('This dataset was created with version %s of the CNNeuro-DS-Generator.' % version)
+    # the transformers seed the global RNG of numpy, so the background work has to happen in processes, not threads
+    with concurrent.futures.ProcessPoolExecutor(max_workers=prefetch) as executor:
+        pending = collections.deque()
+        try:
+            for subject_id, label, job in jobs:
+                pending.append((subject_id, label, executor.submit(__produce_sub, **job)))
+                if len(pending) > prefetch:
+                    subject_id, label, future = pending.popleft()
+                    yield subject_id, label, future.result()
+            while pending:
+                subject_id, label, future = pending.popleft()
+                yield subject_id, label, future.result()
+        finally:  # the consumer may stop early, do not produce subjects nobody asks for
+            for subject_id, label, future in pending:
+                future.cancel()
+
+
+def __grid_region(loc, atrophy_val):
+    """ key of the mask of a grid cell, loc as tuple (an int/float loc is the same as a list with it) """
+    return tuple(loc) if isinstance(loc, list) else (loc,), atrophy_val
+
+
+def __grid_masks(cells, atlas, smoothing_sigma, mask_cache_dir, dtype):
+    """
+    Masks of the cells of a grid that change the subject, built once per process and grid.
+    :return: dict that maps the region (see __grid_region) of a cell to its mask
+    """
+    regions = tuple(sorted(set([__grid_region(loc, atrophy_val) for _, loc, atrophy_val in cells
+                                if loc is not None and atrophy_val != 1])))
+    if isinstance(smoothing_sigma, list):
+        smoothing_sigma = tuple(smoothing_sigma)
+    return __build_grid_masks(os.path.abspath(atlas), os.stat(atlas).st_mtime_ns, regions, smoothing_sigma,
+                              mask_cache_dir, np.dtype(dtype).name)
+
+
+@functools.lru_cache(maxsize=1)
+def __build_grid_masks(atlas, mtime, regions, smoothing_sigma, mask_cache_dir, dtype):
+    # the cache of atrophy_mask only holds a few masks, a grid needs all of them for every subject
+    return {(loc, atrophy_val): atrophy_mask(loc=list(loc), val=atrophy_val, atlas_file=atlas,
+                                             smoothing_sigma=smoothing_sigma, cache_dir=mask_cache_dir, dtype=dtype,
+                                             sparse=True)
+            for loc, atrophy_val in regions}
+
+
+def __grid_sub(ill_sub, cells, atlas, smoothing_sigma, mask_cache_dir, dtype, save_settings):
+    with span('subject', subject=get_ixi_id(ill_sub), ill=True):
+        mri = Volume(mri_file=ill_sub, dtype=dtype)
+        masks = __grid_masks(cells=cells, atlas=atlas, smoothing_sigma=smoothing_sigma, mask_cache_dir=mask_cache_dir,
+                             dtype=dtype)
+        subject_id = get_ixi_id(ill_sub)
+        identity_file = None
+        for ds_dir, loc, atrophy_val in cells:
+            if atrophy_val == 1:  # the subject stays as it is, write it once and copy it to the other identity cells
+                if identity_file is None:
+                    identity_file, _ = __save_sub(mri_file=mri.create_nifti(mri.data), subject_id=subject_id,
+                                                  output_dir=ds_dir, ill=True, **save_settings)
+                else:
+                    link_file(src=identity_file, dest=os.path.join(ds_dir, os.path.basename(identity_file)),
+                              mode=save_settings['healthy_mode'])
+                continue
+            if loc is None:
+                new_data = np.multiply(mri.data, atrophy_val, dtype=dtype)
+            else:
+                mask = masks[__grid_region(loc, atrophy_val)]
+                new_data = concat(mri.data, mask)
+            __save_sub(mri_file=mri.create_nifti(new_data), subject_id=subject_id, output_dir=ds_dir, ill=True,
+                       **save_settings)
+
+
+def __grid_healthy_sub(healthy_sub, ds_dirs, save_settings):
+    with span('subject', subject=get_ixi_id(healthy_sub), ill=False):
+        for ds_dir in ds_dirs:
+            __save_sub(mri_file=healthy_sub, subject_id=get_ixi_id(healthy_sub), output_dir=ds_dir, ill=False,
+                       **save_settings)
+
+
+def generate_grid(input_dir, output_dir, amount_healthy_subs, amount_ill_subs, roi_grid, atrophy_values, atlas, seed,
+                  smoothing_sigma=False, shuffle_subjects=False, workers=None, mask_cache_dir=None, dtype=np.float64,
+                  healthy_mode='copy', output_format='nii', compression_level=6, compression_threads=None,
+                  index_cache=None, trace=None, progress=None):
+    """
+    Generate one atrophy dataset for every combination of a region of roi_grid and a value of atrophy_values.
+    The dataset of the region key and the n-th value (counted from 1) is stored in output_dir/<key>_<n> and is the
+    same as the one generate_dataset creates with the atrophy transformer for these settings. But every subject is
+    loaded only once for the whole grid and every region is blurred only once (see utils.mask.atrophy_basis).
+    :param str input_dir: directory that contains the source subjects
+    :param str output_dir: directory where the datasets will be stored
+    :param int amount_healthy_subs: amount of healthy subjects per dataset
+    :param int amount_ill_subs: amount of ill subjects per dataset
+    :param dict roi_grid: maps the dataset name to the location(s) (see atrophy). None selects the whole brain.
+    :param list atrophy_values: atrophy values (int/float). A value of 1 leaves the subject untouched.
+    :param str atlas: path to atlas file
+    :param int seed: RNG seed
+    :param bool/float smoothing_sigma: If not False, smoothing with given sigma is applied to the masks
+    :param bool shuffle_subjects: if True, the subjects get shuffled before they are split into ill and healthy
+    :param int/None workers: number of worker processes. None or 1 processes every subject in the current process.
+    :param str/None mask_cache_dir: directory for the on-disk cache of the blurred regions (see
+                                    utils.mask.atrophy_basis). If None, they are only kept for the duration of the run.
+    :param numpy.dtype dtype: floating point type (np.float64 or np.float32) in which the subjects are processed
+    :param str healthy_mode: how the healthy subjects (and the identity copies of atrophy value 1) are placed in the
+                             datasets: 'copy', 'hardlink', 'reflink' or 'symlink' (see generate_dataset)
+    :param str output_format: 'nii' or 'nii.gz'
+    :param int compression_level: gzip compression level (0-9) of 'nii.gz' outputs
+    :param int/None compression_threads: maximal amount of threads that compress one volume in parallel (see
+                                         generate_dataset)
+    :param str/None index_cache: file in which the list of subjects of input_dir is cached (see generate_dataset)
+    :param utils.trace.Trace/None trace: if set, the stages of every subject are recorded into it (see
+                                         generate_dataset)
+    :param function/None progress: function that gets called with a progress event after every subject (see
+                                   generate_dataset)
+    :return: run report (see generate_dataset)
+    """
+    save_settings = {'healthy_mode': healthy_mode, 'output_format': output_format,
+                     'compression_level': compression_level, 'compression_threads': compression_threads}
+    __check_options(workers, save_settings)
+    save_settings['compression_threads'] = __compression_threads(compression_threads, workers)
+    if not isinstance(roi_grid, dict) or not isinstance(atrophy_values, list):
+        raise ValueError('roi_grid must be a dict and atrophy_values a list!')
+    if any([not isinstance(val, int) and not isinstance(val, float) for val in atrophy_values]):
+        raise ValueError('Every element in atrophy_values has to be either a int or float!')
+    input_dir = os.path.abspath(input_dir)
+    if not os.path.exists(input_dir):
+        raise Exception('The specified input_dir %s does not exist!' % input_dir)
+    output_dir = os.path.abspath(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    trace = trace if trace is not None else Trace()  # the run report is based on the trace
+    monitor = Progress(trace, callback=progress)
+
+    with record(trace):
+        ill_subs, healthy_subs = __gather_subs(input_dir=input_dir, amount_ill_patients=amount_ill_subs,
+                                               amount_healthy_patients=amount_healthy_subs, shuffle=shuffle_subjects,
+                                               seed=seed, index_cache=index_cache)
+
+    cells = []
+    for key, loc in roi_grid.items():
+        for index, atrophy_val in enumerate(atrophy_values):
+            ds_dir = os.path.join(output_dir, key + '_' + str(index + 1))
+            os.makedirs(ds_dir, exist_ok=True)
+            cells.append((ds_dir, loc, atrophy_val))
+
+    with tempfile.TemporaryDirectory(dir=output_dir) as tmp_dir:
+        if mask_cache_dir is None:
+            mask_cache_dir = tmp_dir
+        # blur every region once, the subjects memory-map the blurred regions from the cache
+        with record(trace):
+            __grid_masks(cells=cells, atlas=atlas, smoothing_sigma=smoothing_sigma, mask_cache_dir=mask_cache_dir,
+                         dtype=dtype)
+
+        jobs = []
+        for ill_sub in ill_subs:
+            jobs.append((__grid_sub, {'ill_sub': ill_sub, 'cells': cells, 'atlas': atlas,
+                                      'smoothing_sigma': smoothing_sigma, 'mask_cache_dir': mask_cache_dir,
+                                      'dtype': dtype, 'save_settings': save_settings}))
+        for healthy_sub in healthy_subs:
+            jobs.append((__grid_healthy_sub, {'healthy_sub': healthy_sub, 'ds_dirs': [cell[0] for cell in cells],
+                                              'save_settings': save_settings}))
+        monitor.total = len(jobs)
+        for _ in __run_jobs(jobs=jobs, workers=workers, trace=trace, progress=monitor):
+            pass
 
+    for ds_dir, loc, atrophy_val in cells:
+        __write_dataset_info(output_dir=ds_dir, ill_subs=ill_subs, healthy_subs=healthy_subs)
+    return monitor.report()
@@ -0,0 +1,203 @@
+from cnneuro_ds_generator.utils.mri import Volume
+from cnneuro_ds_generator.utils.trace import span
+import functools
+import hashlib
+import numpy as np
+import os
+
+
+def load_atlas(atlas_file):
+    """
+    Load an atlas. Every atlas is decoded at most once per process, the cache is keyed by the path and the modification
+    time of the file, so a changed atlas gets read again.
+    The data array of the returned volume is shared and therefore read-only!
+    :param str atlas_file: atlas file
+    :return: Volume of the atlas
+    """
+    atlas_file = os.path.abspath(atlas_file)
+    return __load_atlas(atlas_file, os.stat(atlas_file).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=4)
+def __load_atlas(atlas_file, mtime):
+    atlas = Volume(atlas_file)
+    atlas.data.setflags(write=False)
+    return atlas
+
+
+class LabelIndex:
+    """
+    Voxels of every label of an atlas in compressed sparse row form: the flat (C-order) indices of the voxels with
+    label l are indices[offsets[l]:offsets[l + 1]], in ascending order. Looking up the voxels of a set of labels
+    therefore costs as much as the amount of voxels in it and not a pass over the whole atlas. volume is the atlas as
+    uint16 array, e.g. for lookup tables (lut[volume]).
+    """
+    def __init__(self, shape, labels, offsets, indices, volume):
+        """
+        :param tuple shape: shape of the atlas
+        :param numpy.ndarray labels: labels (uint16) that occur in the atlas, ascending
+        :param numpy.ndarray offsets: start of the voxels of every label value from 0 to the largest label (int64),
+                                      followed by the amount of voxels
+        :param numpy.ndarray indices: flat voxel indices (int32), grouped by label
+        :param numpy.ndarray volume: label of every voxel (uint16, read-only)
+        """
+        self.shape = tuple(shape)
+        self.labels = labels
+        self.offsets = offsets
+        self.indices = indices
+        self.volume = volume
+
+    def voxels(self, loc):
+        """
+        :param list loc: labels
+        :return: flat indices of the voxels that have one of the labels, grouped by label in ascending order
+        """
+        # other labels do not occur in the atlas
+        parts = [self.indices[self.offsets[int(label)]:self.offsets[int(label) + 1]] for label in sorted(set(loc))
+                 if float(label).is_integer() and 0 <= label < len(self.offsets) - 1]
+        return np.concatenate(parts) if parts else np.empty(0, dtype=self.indices.dtype)
+
+
+def label_index(atlas_file):
+    """
+    Build the LabelIndex of an atlas. Like load_atlas, the index is built at most once per process and atlas. The
+    decoded atlas is not kept, so an indexed atlas costs the memory of the index only.
+    :param str atlas_file: atlas file
+    :return: LabelIndex or None if the atlas cannot be indexed (labels that are not integers between 0 and 65535 or
+             more than 2^31 voxels)
+    """
+    atlas_file = os.path.abspath(atlas_file)
+    return __label_index(atlas_file, os.stat(atlas_file).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=4)
+def __label_index(atlas_file, mtime):
+    # decoded without the cache of load_atlas: only the index is kept, the float64 atlas is needed (and then cached)
+    # only by the fallbacks for atlases that cannot be indexed
+    data = Volume(atlas_file).data
+    if data.size >= 2 ** 31 or data.size == 0:
+        return None
+    with span('index', file=atlas_file):
+        flat = data.ravel()  # C-order
+        with np.errstate(invalid='ignore'):
+            labels = flat.astype(np.uint16)
+        if not np.array_equal(labels, flat):
+            return None
+        counts = np.bincount(labels)
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        indices = np.argsort(labels, kind='stable').astype(np.int32)
+        labels.setflags(write=False)
+    return LabelIndex(shape=data.shape, labels=np.flatnonzero(counts).astype(np.uint16), offsets=offsets,
+                      indices=indices, volume=labels.reshape(data.shape))
+
+
+class LabelGeometry:
+    """
+    Geometry of every label of an atlas: the amount of voxels, the centroid (mean voxel coordinates) and the bounding
+    box. Row i of the arrays belongs to labels[i].
+    """
+    def __init__(self, labels, counts, centroids, box_starts, box_stops):
+        """
+        :param numpy.ndarray labels: labels (uint16), ascending
+        :param numpy.ndarray counts: amount of voxels of every label
+        :param numpy.ndarray centroids: (labels, axes) array with the mean voxel coordinates of every label
+        :param numpy.ndarray box_starts: (labels, axes) array with the first voxel of the bounding box of every label
+        :param numpy.ndarray box_stops: (labels, axes) array with the end (excluded) of the bounding box of every label
+        """
+        self.labels = labels
+        self.counts = counts
+        self.centroids = centroids
+        self.box_starts = box_starts
+        self.box_stops = box_stops
+
+    def row(self, label):
+        """
+        :param int/float label: label
+        :return: row of label or None if the label does not occur in the atlas
+        """
+        row = int(np.searchsorted(self.labels, label))
+        return row if row < len(self.labels) and self.labels[row] == label else None
+
+    def centroid(self, label):
+        """
+        :param int/float label: label
+        :return: tuple with the mean voxel coordinates of label (the same as np.average of the coordinates that
+                 np.nonzero returns for the voxels of label)
+        """
+        row = self.row(label)
+        if row is None:
+            raise ValueError('The label %s does not occur in the atlas!' % label)
+        return tuple(self.centroids[row])
+
+    def box(self, label):
+        """
+        :param int/float label: label
+        :return: tuple of slices that selects the bounding box of label
+        """
+        row = self.row(label)
+        if row is None:
+            raise ValueError('The label %s does not occur in the atlas!' % label)
+        return tuple([slice(int(start), int(stop)) for start, stop in zip(self.box_starts[row], self.box_stops[row])])
+
+
+def label_geometry(atlas_file):
+    """
+    Build the LabelGeometry of an atlas from its LabelIndex in one pass over the index. Like load_atlas, the geometry
+    is built at most once per process and atlas.
+    :param str atlas_file: atlas file
+    :return: LabelGeometry or None if the atlas cannot be indexed (see label_index)
+    """
+    atlas_file = os.path.abspath(atlas_file)
+    return __label_geometry(atlas_file, os.stat(atlas_file).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=4)
+def __label_geometry(atlas_file, mtime):
+    index = __label_index(atlas_file, mtime)
+    if index is None:
+        return None
+    with span('index', file=atlas_file):
+        counts = np.diff(index.offsets)[index.labels]
+        starts = index.offsets[index.labels]  # the labels are ascending, so are their voxels in indices
+        sums = np.empty((len(index.labels), len(index.shape)), dtype=np.int64)
+        box_starts = np.empty(sums.shape, dtype=np.int64)
+        box_stops = np.empty(sums.shape, dtype=np.int64)
+        stride = 1
+        for axis in reversed(range(len(index.shape))):  # one coordinate array at a time
+            coords = (index.indices // stride) % index.shape[axis]
+            sums[:, axis] = np.add.reduceat(coords, starts, dtype=np.int64)
+            box_starts[:, axis] = np.minimum.reduceat(coords, starts)
+            box_stops[:, axis] = np.maximum.reduceat(coords, starts) + 1
+            stride *= index.shape[axis]
+        centroids = sums / counts[:, np.newaxis]  # exact sums, like the mean of the coordinates
+    return LabelGeometry(labels=index.labels, counts=counts, centroids=centroids, box_starts=box_starts,
+                         box_stops=box_stops)
+
+
+def atlas_hash(atlas_file):
+    """
+    Return the sha256 hex digest of the content of an atlas file. Like load_atlas, the digest is cached per path and
+    modification time.
+    :param str atlas_file: atlas file
+    :return: str
+    """
+    atlas_file = os.path.abspath(atlas_file)
+    return __atlas_hash(atlas_file, os.stat(atlas_file).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=16)
+def __atlas_hash(atlas_file, mtime):
+    sha = hashlib.sha256()
+    with open(atlas_file, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def clear_atlas_cache():
+    """ Drop every cached atlas """
+    __load_atlas.cache_clear()
+    __label_index.cache_clear()
+    __label_geometry.cache_clear()
+    __atlas_hash.cache_clear()
@@ -0,0 +1,199 @@
+from cnneuro_ds_generator.utils.trace import span
+import concurrent.futures
+import functools
+import gzip
+import hashlib
+import itertools
+import os
+import shutil
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+try:  # zlib-ng is a lot faster than zlib and writes standard gzip files, use it if it is installed
+    from zlib_ng import gzip_ng as gzip_codec
+except ImportError:
+    gzip_codec = gzip
+
+FICLONE = 0x40049409  # ioctl request of Linux to share the extents of a file (reflink / copy-on-write copy)
+LINK_MODES = ('copy', 'hardlink', 'reflink', 'symlink')
+OUTPUT_FORMATS = ('nii', 'nii.gz')
+GZIP_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def remove_file(path):
+    """
+    Remove path if it exists
+    :param str path: path of the file
+    """
+    if os.path.lexists(path):
+        os.unlink(path)
+
+
+def temp_path(path):
+    """ Return a unique temporary path in the directory of path """
+    return '%s.%s.tmp' % (path, uuid.uuid4().hex)
+
+
+def atomic_write(path, data):
+    """
+    Write data to a temporary file and rename it to path afterwards. Readers (and runs that crash in the middle of
+    the write) therefore never see a half-written file, and a file that is hardlinked to path is never changed.
+    :param str path: destination file
+    :param bytes data: content of the file
+    """
+    tmp_path = temp_path(path)
+    try:
+        with open(tmp_path, 'xb') as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        remove_file(tmp_path)
+
+
+def file_sha256(path):
+    """
+    Return the sha256 hex digest of the content of a file
+    :param str path: path of the file
+    :return: str
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def link_file(src, dest, mode='copy'):
+    """
+    Place the file src at dest (atomically, see atomic_write). If the requested mode is not supported (e.g. hardlinks
+    across filesystems or reflinks on a filesystem without copy-on-write support) the file gets copied instead.
+    :param str src: source file
+    :param str dest: destination file
+    :param str mode: 'copy', 'hardlink', 'reflink' or 'symlink'
+    :return: the mode that was actually used
+    """
+    if mode not in LINK_MODES:
+        raise ValueError('mode must be one of %s!' % ', '.join(LINK_MODES))
+    tmp_dest = temp_path(dest)
+    with span('link', file=dest) as event:
+        try:
+            try:
+                if mode == 'hardlink':
+                    os.link(src, tmp_dest)
+                elif mode == 'symlink':
+                    os.symlink(os.path.abspath(src), tmp_dest)
+                elif mode == 'reflink':
+                    __reflink(src, tmp_dest)
+            except OSError:
+                remove_file(tmp_dest)
+                mode = 'copy'
+            if mode == 'copy':
+                shutil.copy(src, tmp_dest)
+                event['bytes_read'] = event['bytes_written'] = os.path.getsize(tmp_dest)
+            os.replace(tmp_dest, dest)
+        finally:
+            remove_file(tmp_dest)
+        event['mode'] = mode
+    return mode
+
+
+def __reflink(src, dest):
+    if fcntl is None:
+        raise OSError('reflinks are not supported on this platform')
+    with open(src, 'rb') as src_file, open(dest, 'wb') as dest_file:
+        fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+
+
+def gzip_compress(data, compression_level=6, threads=None):
+    """
+    Compress data to the gzip format. Data that is larger than GZIP_CHUNK_SIZE is split into chunks which are
+    compressed in parallel as independent gzip members. Concatenated members are a valid gzip file.
+    :param bytes data: data that should get compressed
+    :param int compression_level: compression level between 0 (no compression) and 9 (best compression)
+    :param int/None threads: maximal amount of compression threads. None uses one thread per CPU.
+    :return: compressed data
+    """
+    data = memoryview(data)
+    chunks = [data[start:start + GZIP_CHUNK_SIZE] for start in range(0, len(data), GZIP_CHUNK_SIZE)] or [data]
+    compress = functools.partial(__gzip_member, compression_level=compression_level)
+    threads = min(threads or os.cpu_count() or 1, len(chunks))
+    with span('compress', threads=threads):
+        if threads == 1:
+            return b''.join(map(compress, chunks))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:  # zlib releases the GIL
+            return b''.join(executor.map(compress, chunks))
+
+
+def __gzip_member(chunk, compression_level):
+    return gzip_codec.compress(chunk, compresslevel=compression_level, mtime=0)  # mtime=0 -> reproducible output
+
+
+def save_nifti(nifti, path, compression_level=6, threads=None):
+    """
+    Save nifti at path (atomically, see atomic_write). If path ends with .gz, the file is compressed with
+    gzip_compress.
+    :param nibabel.Nifti1Image nifti: image that should get saved
+    :param str path: destination file (.nii or .nii.gz)
+    :param int compression_level: gzip compression level, only used for .nii.gz
+    :param int/None threads: maximal amount of compression threads, only used for .nii.gz
+    :return: sha256 hex digest of the written file
+    """
+    with span('save', file=path) as event:
+        data = nifti.to_bytes()
+        if path.endswith('.gz'):
+            data = gzip_compress(data, compression_level=compression_level, threads=threads)
+        atomic_write(path, data)
+        event['bytes_written'] = len(data)
+        return hashlib.sha256(data).hexdigest()
+
+
+def transcode_file(src, dest, compression_level=6, threads=None):
+    """
+    Copy src to dest (atomically, see atomic_write) and (de)compress it on the way if only one of them ends with .gz.
+    The file is streamed in chunks of GZIP_CHUNK_SIZE that are compressed like in gzip_compress (so the result is the
+    same), only about one chunk per compression thread is in memory at a time.
+    :param str src: source file (.nii or .nii.gz)
+    :param str dest: destination file (.nii or .nii.gz)
+    :param int compression_level: gzip compression level, only used if dest gets compressed
+    :param int/None threads: maximal amount of compression threads, only used if dest gets compressed
+    :return: sha256 hex digest of the written file
+    """
+    sha256 = hashlib.sha256()
+    with span('save', file=dest, bytes_read=os.path.getsize(src), bytes_written=0) as event:
+        tmp_path = temp_path(dest)
+        try:
+            with (gzip.open(src, 'rb') if src.endswith('.gz') else open(src, 'rb')) as src_file, \
+                    open(tmp_path, 'xb') as dest_file:
+                chunks = iter(functools.partial(src_file.read, GZIP_CHUNK_SIZE), b'')
+                if dest.endswith('.gz'):
+                    chunks = __gzip_stream(chunks, compression_level=compression_level, threads=threads)
+                for chunk in chunks:
+                    dest_file.write(chunk)
+                    sha256.update(chunk)
+                    event['bytes_written'] += len(chunk)
+            os.replace(tmp_path, dest)
+        finally:
+            remove_file(tmp_path)
+        return sha256.hexdigest()
+
+
+def __gzip_stream(chunks, compression_level, threads):
+    """ gzip_compress for an iterator of chunks, yields the gzip members """
+    compress = functools.partial(__gzip_member, compression_level=compression_level)
+    threads = threads or os.cpu_count() or 1
+    empty = True
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        while True:
+            window = list(itertools.islice(chunks, threads))
+            if not window:
+                break
+            with span('compress', threads=min(threads, len(window))):
+                members = list(executor.map(compress, window))
+            empty = False
+            yield from members
+    if empty:  # like gzip_compress, empty data is one empty member
+        yield compress(b'')
@@ -0,0 +1,117 @@
+from cnneuro_ds_generator.utils.files import atomic_write, remove_file
+import functools
+import json
+import numpy as np
+import os
+
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_JOURNAL = 'manifest.journal'
+MANIFEST_VERSION = 1
+
+
+def file_fingerprint(path):
+    """
+    Cheap identity of a file (path, size and modification time) that changes whenever the file gets rewritten
+    :param str path: path of the file
+    :return: dict
+    """
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def canonicalize(value, file_key=file_fingerprint):
+    """
+    Convert (transformer) settings into a canonical, JSON serializable form: dicts get sorted, tuples become lists,
+    numpy scalars and dtypes become python values and names, functions their qualified name (functools.partial
+    objects their function and arguments) and paths of existing files are replaced by file_key(path).
+    Values without a canonical form are represented by their repr.
+    :param value: value that should get converted
+    :param function file_key: function that identifies a file
+    :return: canonical form of value
+    """
+    if isinstance(value, dict):
+        return {str(key): canonicalize(value[key], file_key) for key in sorted(value, key=str)}
+    if isinstance(value, (list, tuple)):
+        return [canonicalize(elem, file_key) for elem in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.dtype) or (isinstance(value, type) and issubclass(value, np.generic)):
+        return np.dtype(value).name
+    if isinstance(value, functools.partial):
+        return {'partial': canonicalize(value.func, file_key), 'args': canonicalize(value.args, file_key),
+                'keywords': canonicalize(value.keywords, file_key)}
+    if callable(value):
+        return value.__module__ + '.' + value.__qualname__
+    if isinstance(value, str) and os.path.isfile(value):
+        return file_key(value)
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return repr(value)
+
+
+def load_manifest(output_dir):
+    """
+    Load the entries of the manifest of a dataset, including the ones that were appended to its journal (see
+    append_manifest) by a run that did not finish
+    :param str output_dir: directory of the dataset
+    :return: dict that maps the output file names to their entries. Empty if there is no (readable) manifest.
+    """
+    try:
+        with open(os.path.join(output_dir, MANIFEST_FILE), 'r') as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION:
+        return {}
+    entries = manifest.get('subjects', {})
+    try:
+        with open(os.path.join(output_dir, MANIFEST_JOURNAL), 'r') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:  # the last line of a run that crashed while appending it
+                    break
+                entries[record['name']] = record['entry']
+    except OSError:
+        pass
+    return entries
+
+
+def write_manifest(output_dir, entries):
+    """
+    Write the manifest of a dataset (atomically, see utils.files.atomic_write). The journal is folded into it, so it
+    gets removed.
+    :param str output_dir: directory of the dataset
+    :param dict entries: maps the output file names to their entries
+    """
+    manifest = {'version': MANIFEST_VERSION, 'subjects': entries}
+    atomic_write(os.path.join(output_dir, MANIFEST_FILE), json.dumps(manifest, sort_keys=True).encode())
+    remove_file(os.path.join(output_dir, MANIFEST_JOURNAL))
+
+
+def append_manifest(output_dir, name, entry):
+    """
+    Record the entry of one output in the journal of the manifest. Appending costs the size of the entry only, unlike
+    rewriting the whole manifest after every subject. load_manifest applies the journal on top of the manifest.
+    :param str output_dir: directory of the dataset
+    :param str name: name of the output file
+    :param dict entry: manifest entry
+    """
+    with open(os.path.join(output_dir, MANIFEST_JOURNAL), 'a') as file:
+        file.write(json.dumps({'name': name, 'entry': entry}, sort_keys=True) + '\n')
+
+
+def output_matches(output_dir, name, entry):
+    """
+    Check whether the output file of a manifest entry still is the file that was recorded
+    :param str output_dir: directory of the dataset
+    :param str name: name of the output file
+    :param dict entry: manifest entry
+    :return: bool
+    """
+    try:
+        stat = os.stat(os.path.join(output_dir, name))
+    except OSError:
+        return False
+    output = entry.get('output', {})
+    return output.get('size') == stat.st_size and output.get('mtime_ns') == stat.st_mtime_ns
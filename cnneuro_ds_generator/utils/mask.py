@@ -1,13 +1,55 @@
-from cnneuro_ds_generator.utils.mri import Volume
+from cnneuro_ds_generator.utils.atlas import atlas_hash, label_geometry, label_index, load_atlas
+from cnneuro_ds_generator.utils.files import atomic_write
+from cnneuro_ds_generator.utils.mri import Volume, gaussian_blur, kernel_radii
+from cnneuro_ds_generator.utils.trace import span
+import functools
+import hashlib
+import json
 import numpy as np
+import os
+import tempfile
 
 
-def roi_mask(loc, val, atlas_file):
+class MaskPatch:
+    """
+    Compact mask: the values inside of a box are stored densely in block, every voxel outside of the box has the
+    value background (1 for a roi_mask). Multiplying a volume with it (see concat) only touches the box.
+    np.asarray(patch) returns the dense mask.
+    """
+    def __init__(self, shape, box, block, background=1.):
+        """
+        :param tuple shape: shape of the whole mask
+        :param tuple box: tuple of slices (one per axis, without step) that selects the box
+        :param numpy.ndarray block: values inside of the box
+        :param float background: value outside of the box
+        """
+        self.shape = tuple(shape)
+        self.box = tuple(box)
+        self.block = block
+        self.background = block.dtype.type(background)
+        if self.block.shape != tuple([axis.stop - axis.start for axis in self.box]):
+            raise ValueError('The shape of block must be the shape of the box!')
+
+    @property
+    def dtype(self):
+        return self.block.dtype
+
+    def __array__(self, dtype=None, copy=None):
+        mask = np.full(self.shape, self.background, dtype=self.dtype)
+        mask[self.box] = self.block
+        return mask if dtype is None else mask.astype(dtype)
+
+
+def roi_mask(loc, val, atlas_file, dtype=np.float64, sparse=False, planes=None):
     """
     Creates mask where the in loc specified locations are set equal to val and every other location has the value 1.
     :param list/int/float loc: location(s) that should get set to the specified value
     :param int/float val: value for the location(s)
-    :param str atlas_file: atlas file
+    :param str atlas_file: atlas file (cached and indexed, see utils.atlas.label_index)
+    :param numpy.dtype dtype: dtype of the mask
+    :param bool sparse: If True, a MaskPatch that only stores the bounding box of the locations is returned
+    :param tuple/None planes: (start, stop): only create the mask for these planes of the last axis (a slab). The atlas
+                              is read slab-wise through the array proxy of nibabel then instead of being cached.
     :return: mask
     """
     if not isinstance(loc, list) and not isinstance(loc, int) and not isinstance(loc, float):
@@ -16,26 +58,365 @@ def roi_mask(loc, val, atlas_file):
         raise ValueError('Every element in loc has to be either a int or float!')
     if isinstance(loc, int) or isinstance(loc, float):
         loc = [loc]
-    atlas = Volume(atlas_file)
-    mask = np.copy(atlas.data)
-    target = np.isin(mask, loc)
-    mask[target] = val
-    mask[np.logical_not(target)] = 1
+    index = label_index(atlas_file) if planes is None else None
+    if index is not None:  # only the voxels of the locations are touched
+        with span('mask'):
+            voxels = index.voxels(loc)
+            if sparse:
+                coords = np.unravel_index(voxels, index.shape)
+                if len(voxels) == 0:
+                    box = tuple([slice(0, 0)] * len(index.shape))
+                else:
+                    box = tuple([slice(int(axis.min()), int(axis.max()) + 1) for axis in coords])
+                block = np.ones(tuple([axis.stop - axis.start for axis in box]), dtype=dtype)
+                block[tuple([axis - start.start for axis, start in zip(coords, box)])] = val
+                return MaskPatch(shape=index.shape, box=box, block=block)
+            mask = np.ones(index.shape, dtype=dtype)
+            mask.reshape(-1)[voxels] = val
+        return mask
+
+    if planes is None:
+        atlas = load_atlas(atlas_file).data
+    else:
+        atlas = Volume(atlas_file).slab(*planes)
+    with span('mask'):
+        target = np.isin(atlas, loc)
+        if sparse:
+            box = __bounding_box(target)
+            block = np.ones(target[box].shape, dtype=dtype)
+            block[target[box]] = val
+            return MaskPatch(shape=target.shape, box=box, block=block)
+        mask = np.ones(atlas.shape, dtype=dtype)
+        mask[target] = val
+    return mask
+
+
+def __bounding_box(selection):
+    """
+    :param numpy.ndarray selection: boolean array
+    :return: tuple of slices that selects the bounding box of the True voxels (empty if there is none)
+    """
+    box = []
+    for axis in range(selection.ndim):
+        indices = np.flatnonzero(selection.any(axis=tuple([other for other in range(selection.ndim) if other != axis])))
+        if len(indices) == 0:
+            return tuple([slice(0, 0)] * selection.ndim)
+        box.append(slice(int(indices[0]), int(indices[-1]) + 1))
+    return tuple(box)
+
+
+def lut_mask(factors, atlas_file, smoothing_sigma=False, dtype=np.float64, sparse=False):
+    """
+    Creates mask where every location of factors has its own value (e.g. {41: .6, 3: .85}) and every other location
+    the value 1. The values are put into a lookup table that is indexed with the labels of the atlas, so the mask is
+    built in one pass however many locations there are. It is blurred if smoothing_sigma is set. Such a mask does not
+    depend on the subject, so it is only computed once per process and reused afterwards.
+    The returned mask is shared and therefore read-only!
+    :param dict factors: maps every location to its value
+    :param str atlas_file: atlas file (cached and indexed, see utils.atlas.label_index)
+    :param bool/float/tuple smoothing_sigma: If not False, smoothing with given sigma is applied to the mask
+    :param numpy.dtype dtype: dtype of the mask
+    :param bool sparse: If True, a MaskPatch that only stores the bounding box of the locations is returned
+    :return: mask
+    """
+    if not isinstance(factors, dict):
+        raise ValueError('factors must be a dict!')
+    elems = list(factors) + list(factors.values())
+    if any([not isinstance(elem, int) and not isinstance(elem, float) for elem in elems]):
+        raise ValueError('The locations and values in factors have to be either int or float!')
+    atlas_file = os.path.abspath(atlas_file)
+    if isinstance(smoothing_sigma, list):
+        smoothing_sigma = tuple(smoothing_sigma)
+    return __lut_mask(atlas_file, os.stat(atlas_file).st_mtime_ns, tuple(sorted(factors.items())), smoothing_sigma,
+                      np.dtype(dtype).name, sparse)
+
+
+@functools.lru_cache(maxsize=2)
+def __lut_mask(atlas_file, mtime, factors, smoothing_sigma, dtype, sparse):
+    index = label_index(atlas_file)
+    if index is None:  # the atlas can not be indexed, one pass per location
+        atlas = load_atlas(atlas_file).data
+        with span('mask'):
+            mask = np.ones(atlas.shape, dtype=dtype)
+            for label, factor in factors:
+                mask[atlas == label] = factor
+            if sparse:
+                box = __bounding_box(mask != 1)
+                mask = MaskPatch(shape=mask.shape, box=box, block=mask[box].copy())
+    else:
+        geometry = label_geometry(atlas_file)
+        with span('mask'):
+            lut = np.ones(len(index.offsets) - 1, dtype=dtype)  # one entry for every label value up to the largest
+            for label, factor in factors:
+                if float(label).is_integer() and 0 <= label < len(lut):  # others do not occur in the atlas
+                    lut[int(label)] = factor
+            if sparse:
+                box = __union_box([geometry.box(label) for label in index.labels if lut[label] != 1], len(index.shape))
+                mask = MaskPatch(shape=index.shape, box=box, block=lut[index.volume[box]])
+            else:
+                mask = lut[index.volume]
+    if smoothing_sigma:
+        mask = blur_mask(mask=mask, sigma=smoothing_sigma)
+    (mask.block if sparse else mask).setflags(write=False)
+    return mask
+
+
+def __union_box(boxes, ndim):
+    """ smallest box that contains every (non-empty) box of boxes, empty if there is none """
+    if not boxes:
+        return tuple([slice(0, 0)] * ndim)
+    return tuple([slice(min([axis.start for axis in axes]), max([axis.stop for axis in axes])) for axes in zip(*boxes)])
+
+
+def atrophy_mask(loc, val, atlas_file, smoothing_sigma=False, cache_dir=None, dtype=np.float64, sparse=False):
+    """
+    Creates the roi_mask for loc and val and blurs it if smoothing_sigma is set. The blurred mask is built from the
+    blurred indicator of loc (see atrophy_basis), so the blur is computed once for every atrophy value. Such a mask
+    does not depend on the subject, so it is only computed once per process and reused afterwards. For val == 1 the
+    mask is exactly 1 everywhere, the blur is skipped.
+    The returned mask is shared and therefore read-only!
+    :param list/int/float loc: location(s) that should get set to the specified value
+    :param int/float val: value for the location(s)
+    :param str atlas_file: atlas file
+    :param bool/float/tuple smoothing_sigma: If not False, smoothing with given sigma is applied to the mask
+    :param str/None cache_dir: directory for the on-disk cache of the blurred indicators. None disables the on-disk
+                               cache.
+    :param numpy.dtype dtype: dtype of the mask
+    :param bool sparse: If True, the mask is a MaskPatch (see roi_mask)
+    :return: mask
+    """
+    if isinstance(loc, int) or isinstance(loc, float):
+        loc = [loc]
+    if not isinstance(loc, list):
+        raise ValueError('loc must be int, float or a list!')
+    atlas_file = os.path.abspath(atlas_file)
+    if isinstance(smoothing_sigma, list):
+        smoothing_sigma = tuple(smoothing_sigma)
+    return __atrophy_mask(atlas_file, os.stat(atlas_file).st_mtime_ns, tuple(sorted(set(loc))), val, smoothing_sigma,
+                          cache_dir, np.dtype(dtype).name, sparse)
+
+
+@functools.lru_cache(maxsize=2)
+def __atrophy_mask(atlas_file, mtime, loc, val, smoothing_sigma, cache_dir, dtype, sparse):
+    if smoothing_sigma and val != 1:  # a mask of ones stays ones
+        basis = atrophy_basis(loc=list(loc), atlas_file=atlas_file, smoothing_sigma=smoothing_sigma,
+                              cache_dir=cache_dir, dtype=dtype)
+        mask = basis_mask(basis=basis, val=val, smoothing_sigma=smoothing_sigma)
+        if not sparse:
+            mask = np.asarray(mask)
+    else:
+        mask = roi_mask(loc=list(loc), val=val, atlas_file=atlas_file, dtype=dtype, sparse=sparse)
+    (mask.block if sparse else mask).setflags(write=False)
     return mask
 
 
-def concat(mri_data, mask_data):
+def atrophy_basis(loc, atlas_file, smoothing_sigma, cache_dir=None, dtype=np.float64, planes=None):
+    """
+    Blurred indicator of loc, i.e. the blur of a mask that is 1 at the locations and 0 everywhere else. The blur is
+    linear, so the blurred roi_mask of any value is blur(1) + (value - 1) * basis (see basis_mask).
+    The basis is only computed once per process and reused afterwards. If cache_dir is set, it is also stored there
+    (keyed by the hash of the atlas, loc and smoothing_sigma) and later runs (or other processes) memory-map it from
+    disk. The returned basis is shared and therefore read-only!
+    :param list/int/float loc: location(s)
+    :param str atlas_file: atlas file
+    :param float/tuple smoothing_sigma: gauss-sigma
+    :param str/None cache_dir: directory for the on-disk cache. None disables the on-disk cache.
+    :param numpy.dtype dtype: dtype of the basis
+    :param tuple/None planes: (start, stop): only compute the basis of a slab (see roi_mask). Such a basis is not
+                              cached.
+    :return: MaskPatch with background 0 that covers the box within the radius of the kernel around loc
+    """
+    if isinstance(loc, int) or isinstance(loc, float):
+        loc = [loc]
+    if not isinstance(loc, list):
+        raise ValueError('loc must be int, float or a list!')
+    if planes is not None:
+        return __blur_indicator(loc=loc, atlas_file=atlas_file, smoothing_sigma=smoothing_sigma, dtype=dtype,
+                                planes=planes)
+    atlas_file = os.path.abspath(atlas_file)
+    if isinstance(smoothing_sigma, list):
+        smoothing_sigma = tuple(smoothing_sigma)
+    return __atrophy_basis(atlas_file, os.stat(atlas_file).st_mtime_ns, tuple(sorted(set(loc))), smoothing_sigma,
+                           cache_dir, np.dtype(dtype).name)
+
+
+@functools.lru_cache(maxsize=8)
+def __atrophy_basis(atlas_file, mtime, loc, smoothing_sigma, cache_dir, dtype):
+    cache_file = None
+    if cache_dir is not None:
+        key = json.dumps([atlas_hash(atlas_file), loc, smoothing_sigma, dtype])
+        cache_file = os.path.join(cache_dir, 'atrophy-basis-%s.npy' % hashlib.sha256(key.encode()).hexdigest())
+        if os.path.isfile(cache_file):
+            with span('load', file=cache_file):  # read-only and shared with other processes via the page cache
+                data = np.load(cache_file, mmap_mode='r')
+                with open(cache_file[:-len('.npy')] + '.json', 'r') as file:
+                    patch = json.load(file)
+                return MaskPatch(shape=patch['shape'], box=[slice(*axis) for axis in patch['box']], block=data,
+                                 background=patch['background'])
+
+    basis = __blur_indicator(loc=list(loc), atlas_file=atlas_file, smoothing_sigma=smoothing_sigma, dtype=dtype)
+    basis.block.setflags(write=False)
+
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        with span('save', file=cache_file, bytes_written=basis.block.nbytes):
+            # written before the block, a readable block always has its box
+            patch = {'shape': basis.shape, 'box': [[axis.start, axis.stop] for axis in basis.box],
+                     'background': basis.background.item()}
+            atomic_write(cache_file[:-len('.npy')] + '.json', json.dumps(patch).encode())
+            fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix='.npy.tmp')
+            with os.fdopen(fd, 'wb') as file:
+                np.save(file, basis.block)
+            os.replace(tmp_file, cache_file)  # atomic, concurrent runs never see a half-written basis
+    return basis
+
+
+def __blur_indicator(loc, atlas_file, smoothing_sigma, dtype, planes=None):
+    roi = roi_mask(loc=loc, val=0, atlas_file=atlas_file, dtype=dtype, sparse=True, planes=planes)
+    indicator = MaskPatch(shape=roi.shape, box=roi.box, block=1 - roi.block, background=0)
+    return blur_mask(mask=indicator, sigma=smoothing_sigma, dtype=dtype)
+
+
+def label_bases(labels, atlas_file, smoothing_sigma, cache_dir=None, dtype=np.float64):
+    """
+    atrophy_basis of every single label, e.g. of all labels random subsets are drawn from (loc_max of atrophy). The
+    bases of a set of labels are only computed once per process and reused afterwards.
+    The returned bases are shared and therefore read-only!
+    :param list labels: labels
+    :param str atlas_file: atlas file
+    :param float/tuple smoothing_sigma: gauss-sigma
+    :param str/None cache_dir: directory for the on-disk cache (see atrophy_basis)
+    :param numpy.dtype dtype: dtype of the bases
+    :return: dict that maps every label to its atrophy_basis
+    """
+    atlas_file = os.path.abspath(atlas_file)
+    if isinstance(smoothing_sigma, list):
+        smoothing_sigma = tuple(smoothing_sigma)
+    return __label_bases(atlas_file, os.stat(atlas_file).st_mtime_ns, tuple(sorted(set(labels))), smoothing_sigma,
+                         cache_dir, np.dtype(dtype).name)
+
+
+@functools.lru_cache(maxsize=2)
+def __label_bases(atlas_file, mtime, labels, smoothing_sigma, cache_dir, dtype):
+    return {label: atrophy_basis(loc=[label], atlas_file=atlas_file, smoothing_sigma=smoothing_sigma,
+                                 cache_dir=cache_dir, dtype=dtype) for label in labels}
+
+
+def sum_bases(bases, loc):
+    """
+    atrophy_basis of loc as the sum of the bases of its labels (the blur is linear). Only the boxes of the bases get
+    added, so this is a lot cheaper than blurring the locations. The labels are added in ascending order, the result
+    does not depend on the order of loc.
+    :param dict bases: maps every label of loc to its atrophy_basis (see label_bases)
+    :param list loc: labels
+    :return: MaskPatch with background 0
+    """
+    parts = [bases[label] for label in sorted(set(loc))]
+    parts_in_atlas = [part for part in parts if all([axis.start < axis.stop for axis in part.box])]
+    box = __union_box([part.box for part in parts_in_atlas], len(parts[0].shape))
+    with span('mask'):
+        block = np.zeros(tuple([axis.stop - axis.start for axis in box]), dtype=parts[0].dtype)
+        for part in parts_in_atlas:
+            block[__shift(part.box, box)] += part.block
+    return MaskPatch(shape=parts[0].shape, box=box, block=block, background=0)
+
+
+def basis_mask(basis, val, smoothing_sigma):
+    """
+    Blurred roi_mask with val built from an atrophy_basis with one multiply-add: blur(1) + (val - 1) * basis. Away
+    from the locations the mask is the blurred background of a roi_mask (see blur_mask).
+    :param MaskPatch basis: atrophy_basis
+    :param int/float val: value for the location(s)
+    :param float/tuple smoothing_sigma: gauss-sigma of the basis
+    :return: MaskPatch
+    """
+    background = __blurred_background(ndim=len(basis.shape), sigma=smoothing_sigma, background=1, dtype=basis.dtype)
+    with span('mask'):
+        block = np.multiply(basis.block, val - 1, dtype=basis.dtype)
+        block += background
+    return MaskPatch(shape=basis.shape, box=basis.box, block=block, background=background)
+
+
+def __blurred_background(ndim, sigma, background, dtype, blurred_dtype=None):
+    """ blurred value of a constant background, blurring a volume of it goes through the same arithmetic """
+    return gaussian_blur(data_arr=np.full((1,) * ndim, background, dtype=dtype), sigma=sigma,
+                         dtype=blurred_dtype).item()
+
+
+def blur_mask(mask, sigma, dtype=None):
+    """
+    Gaussian blur (see utils.mri.gaussian_blur) of a mask that is constant outside of the ROI (1 for a roi_mask, the
+    background of a MaskPatch). Only the bounding box of the ROI, padded by twice the radius of the kernel, gets
+    blurred. Further away from the ROI the blurred mask is the blurred background everywhere. The result is exactly
+    the same as the one of blurring the whole mask, but small ROIs are a lot faster.
+    :param numpy.ndarray/MaskPatch mask: mask. The background of an array has to be 1.
+    :param float/tuple sigma: gauss-sigma
+    :param numpy.dtype/None dtype: dtype of the result. None keeps the dtype of mask.
+    :return: blurred mask, a MaskPatch that covers the box within the radius of the kernel around the ROI if mask is a
+             MaskPatch
+    """
+    if not isinstance(mask, np.ndarray) and not isinstance(mask, MaskPatch):
+        raise ValueError('mask has to be of type numpy.ndarray or MaskPatch!')
+    dtype = mask.dtype if dtype is None else np.dtype(dtype)
+    outside = mask.background if isinstance(mask, MaskPatch) else 1
+    background = __blurred_background(ndim=len(mask.shape), sigma=sigma, background=outside, dtype=mask.dtype,
+                                      blurred_dtype=dtype)
+    roi = mask.box if isinstance(mask, MaskPatch) else __bounding_box(mask != 1)
+    if any([axis.start == axis.stop for axis in roi]):  # no ROI, the mask is background only
+        if isinstance(mask, MaskPatch):
+            return MaskPatch(shape=mask.shape, box=roi, block=np.full(mask.block.shape, background, dtype=dtype),
+                             background=background)
+        return np.full(mask.shape, background, dtype=dtype)
+
+    radii = kernel_radii(sigma, len(mask.shape))
+    # the voxels within radius of the ROI depend on the mask within 2 * radius of the ROI
+    crop = tuple([slice(max(axis.start - 2 * radius, 0), min(axis.stop + 2 * radius, length))
+                  for axis, radius, length in zip(roi, radii, mask.shape)])
+    keep = tuple([slice(max(axis.start - radius, 0), min(axis.stop + radius, length))
+                  for axis, radius, length in zip(roi, radii, mask.shape)])
+    if isinstance(mask, MaskPatch):
+        crop_mask = np.full(tuple([axis.stop - axis.start for axis in crop]), outside, dtype=mask.dtype)
+        crop_mask[__shift(roi, crop)] = mask.block
+    else:
+        crop_mask = mask[crop]
+    crop_blurred = gaussian_blur(data_arr=crop_mask, sigma=sigma, dtype=dtype)[__shift(keep, crop)]
+    if isinstance(mask, MaskPatch):
+        return MaskPatch(shape=mask.shape, box=keep, block=crop_blurred, background=background)
+    blurred = np.full(mask.shape, background, dtype=dtype)
+    blurred[keep] = crop_blurred
+    return blurred
+
+
+def __shift(box, origin):
+    """ box relative to the start of the box origin """
+    return tuple([slice(axis.start - start.start, axis.stop - start.start) for axis, start in zip(box, origin)])
+
+
+def concat(mri_data, mask_data, out=None):
     """
     Concat mri volume with a suitable mask
     :param numpy.ndarray mri_data: mri data array
-    :param numpy.ndarray mask_data: mask data array
+    :param numpy.ndarray/MaskPatch mask_data: mask data array or patch. A MaskPatch with background 1 only touches
+                                              the voxels in its box.
+    :param numpy.ndarray/None out: array the result is written to, e.g. mri_data to apply the mask in place (the dtype
+                                   of mri_data has to be the one of the result then). None allocates a new array.
     :return: mri volume with applied mask
     """
-    if not isinstance(mri_data, np.ndarray) or not isinstance(mask_data, np.ndarray):
-        raise ValueError('mri_data and mask_data must be of type numpy.ndarray')
+    if not isinstance(mri_data, np.ndarray) or \
+            (not isinstance(mask_data, np.ndarray) and not isinstance(mask_data, MaskPatch)):
+        raise ValueError('mri_data must be of type numpy.ndarray and mask_data of type numpy.ndarray or MaskPatch')
     if mri_data.shape != mask_data.shape:
         raise ValueError('Shape of the mask must be the same as the shape of the mri')
-    return np.multiply(mri_data, mask_data)
+    with span('apply'):
+        if isinstance(mask_data, np.ndarray):
+            return np.multiply(mri_data, mask_data, out=out)
+        box_data = np.multiply(mri_data[mask_data.box], mask_data.block)
+        if out is None:
+            out = np.empty(mri_data.shape, dtype=box_data.dtype)
+        if out is not mri_data or mask_data.background != 1:
+            np.multiply(mri_data, mask_data.background, out=out)
+        out[mask_data.box] = box_data
+        return out
 
 
 def rand_loc_subset(loc, loc_max, seed):
@@ -1,8 +1,10 @@
+from cnneuro_ds_generator.utils.trace import span
 from scipy.ndimage.filters import gaussian_filter
 import nibabel as nib
 import numpy as np
 import os
 
+GAUSSIAN_TRUNCATE = 4.0  # the gaussian kernels are truncated at this many standard deviations (default of scipy)
 
 def mid_pos(data_arr):
     """
@@ -12,7 +14,16 @@ def mid_pos(data_arr):
     """
     if not isinstance(data_arr, np.ndarray):
         raise ValueError('data_arr has to be of type numpy.ndarray!')
-    x_shape, y_shape, z_shape = data_arr.shape
+    return shape_mid_pos(data_arr.shape)
+
+
+def shape_mid_pos(shape):
+    """
+    Return the position of the mid of a volume with the given shape
+    :param tuple shape: shape of the volume
+    :return: tuple containing position of the mid
+    """
+    x_shape, y_shape, z_shape = shape
     x_mid = (x_shape - 1) // 2
     y_mid = (y_shape - 1) // 2
     z_mid = (z_shape - 1) // 2
@@ -51,29 +62,92 @@ def rand_pos_shift(pos, min_offset, max_offset, seed):
     return x, y, z
 
 
-def gaussian_blur(data_arr, sigma):
+def gaussian_blur(data_arr, sigma, dtype=None):
     """
     Apply gaussian blur
     :param numpy.ndarray data_arr: the MRI data array
     :param float/tuple sigma: gauss-sigma
+    :param numpy.dtype/None dtype: dtype of the result. None keeps the dtype of data_arr.
     :return: image with applied gaussian blur
     """
     if not isinstance(data_arr, np.ndarray):
         raise ValueError('data_arr has to be of type numpy.ndarray!!!')
-    return gaussian_filter(data_arr, sigma=sigma)
+    with span('blur'):
+        return gaussian_filter(data_arr, sigma=sigma, output=dtype, truncate=GAUSSIAN_TRUNCATE)
+
+
+def kernel_radii(sigma, ndim):
+    """
+    :param float/tuple sigma: gauss-sigma
+    :param int ndim: amount of axes of the blurred array
+    :return: list with the radius (in voxels) of the kernel of gaussian_blur along every axis
+    """
+    return [int(GAUSSIAN_TRUNCATE * axis_sigma + 0.5) for axis_sigma in
+            np.broadcast_to(np.asarray(sigma, dtype=np.float64), (ndim,))]  # like scipy.ndimage
 
 
 class Volume:
-    def __init__(self, mri_file):
+    def __init__(self, mri_file, dtype=np.float64, mmap=False):
+        """
+        Only the header is read here, the voxel data gets loaded on the first access of data.
+        :param str mri_file: nifti file
+        :param numpy.dtype dtype: floating point type of the data array (np.float64 or np.float32). np.float32 halves the
+                                  memory and bandwidth of every following operation.
+        :param bool mmap: If True and the voxel data of the file can be used as it is (see memmap), data is a read-only
+                          memory-mapped view of the file instead of an array in memory.
+        """
         self.mri = nib.load(mri_file)
-        self.data = self.mri.get_fdata()
-        self.data = np.asarray(self.data)
+        self.dtype = np.dtype(dtype)
+        self.mmap = mmap
+        self.__data = None
+
+    @property
+    def data(self):
+        if self.__data is None:
+            with span('load', file=self.mri.get_filename()) as event:
+                if self.mmap:
+                    self.__data = self.memmap()
+                if self.__data is None:
+                    self.__data = np.asarray(self.mri.get_fdata(dtype=self.dtype))
+                    event['bytes_read'] = os.path.getsize(self.mri.get_filename())
+        return self.__data
+
+    @property
+    def shape(self):
+        return self.mri.shape
+
+    def memmap(self):
+        """
+        Read-only memory-mapped view of the voxel data, read through the array proxy of nibabel. This is only possible
+        for uncompressed nifti files whose data is stored unscaled in the requested dtype.
+        :return: numpy.memmap or None if the data of the file has to be decoded
+        """
+        proxy = nib.load(self.mri.get_filename(), mmap='r').dataobj
+        if not nib.is_proxy(proxy) or proxy.dtype != self.dtype or proxy.slope != 1 or proxy.inter != 0:
+            return None
+        data = proxy.get_unscaled()
+        if not isinstance(data, np.memmap):  # e.g. a compressed file
+            return None
+        return data
+
+    def slab(self, start, stop):
+        """
+        Planes start to stop (excluded) of the last axis of the voxel data, read through the array proxy of nibabel
+        without loading the rest of the volume. The values are the same as the ones of data[..., start:stop].
+        :param int start: first plane
+        :param int stop: end of the slab
+        :return: numpy.ndarray in dtype
+        """
+        with span('load', file=self.mri.get_filename(), planes=[start, stop]) as event:
+            data = np.array(self.mri.dataobj[..., start:stop], dtype=self.dtype)
+            event['bytes_read'] = int(np.prod(data.shape)) * self.mri.get_data_dtype().itemsize
+        return data
 
     def mean(self):
         return np.mean(self.data)
 
     def mid_pos(self):
-        return mid_pos(self.data)
+        return shape_mid_pos(self.shape)
 
     def create_nifti(self, data_arr, path=None):
         """
@@ -88,3 +162,25 @@ class Volume:
                 path = os.path.join(os.getcwd(), path)
             nib.save(nifti, path)
         return nifti
+
+    def create_nifti_file(self, path):
+        """
+        Preallocate an uncompressed nifti file with the shape, affine and header of the volume (every voxel is 0) that
+        gets filled part by part afterwards. The data type of the file is the one of the original file, except for
+        integer types: their scaling depends on the final data, so np.float32 is used instead.
+        :param str path: destination, has to end with .nii
+        :return: writable numpy.memmap of the voxel data of the file. Flush it (or delete it) when it is filled.
+        """
+        if not path.endswith('.nii'):
+            raise ValueError('The file has to be an uncompressed nifti file (.nii)!')
+        dtype = self.mri.get_data_dtype()
+        if not np.issubdtype(dtype, np.floating):
+            dtype = np.dtype(np.float32)
+        # zeros without memory, the header is written by nibabel exactly as for a volume in memory
+        zeros = np.broadcast_to(np.zeros((), dtype=dtype), self.shape)
+        nifti = nib.Nifti1Image(zeros, self.mri.affine, self.mri.header)
+        nifti.set_data_dtype(dtype)
+        with span('save', file=path):
+            nib.save(nifti, path)
+        proxy = nib.load(path).dataobj
+        return np.memmap(path, dtype=proxy.dtype, mode='r+', offset=proxy.offset, shape=self.shape, order='F')
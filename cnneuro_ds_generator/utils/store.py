@@ -0,0 +1,139 @@
+from cnneuro_ds_generator.utils.files import atomic_write, file_sha256, link_file, remove_file
+from cnneuro_ds_generator.utils.manifest import canonicalize
+from cnneuro_ds_generator.utils.trace import span
+import cnneuro_ds_generator
+import functools
+import hashlib
+import json
+import os
+
+
+def content_hash(path):
+    """
+    Return the sha256 hex digest of the content of a file. The digest is cached per path, size and modification time,
+    only the first call reads the file (recorded as 'hash' span).
+    :param str path: path of the file
+    :return: str
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    return __content_hash(path, stat.st_size, stat.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=4096)
+def __content_hash(path, size, mtime):
+    with span('hash', file=path, bytes_read=size):
+        return file_sha256(path)
+
+
+class SubjectStore:
+    """
+    Content-addressed store of transformed subjects. An object is addressed by the hash of the content of the input
+    file, the transformer, its canonicalised settings (files in the settings, e.g. the atlas, by their content), the
+    seed, the output format and the version of the CNNeuro-DS-Generator.
+    Objects are hardlinked (or copied) into and out of the store. Every object has a sidecar file with the sha256 of
+    its content, the modification time of the sidecar is the last use of the object. If size_limit is set, the least
+    recently used objects are evicted as soon as the store gets bigger.
+    """
+    def __init__(self, store_dir, size_limit=None):
+        """
+        :param str store_dir: directory of the store
+        :param int/None size_limit: maximal size of the store in bytes. None means unlimited.
+        """
+        if size_limit is not None and (not isinstance(size_limit, int) or size_limit < 0):
+            raise ValueError('size_limit must be None or an int greater than or equal to 0!')
+        self.store_dir = os.path.abspath(store_dir)
+        self.size_limit = size_limit
+        self.size = None  # bytes in the store, only tracked if there is a size limit (see add_size)
+
+    def key(self, input_file, transformer, transformer_settings, seed, output_format, compression_level):
+        """
+        :return: address of the transformed subject
+        """
+        description = {
+            'input': content_hash(input_file),
+            'transformer': canonicalize(transformer, file_key=content_hash),
+            'settings': canonicalize(transformer_settings, file_key=content_hash),
+            'seed': seed,
+            'output_format': output_format,
+            'compression_level': compression_level if output_format.endswith('.gz') else None,
+            'version': cnneuro_ds_generator.__version__
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def path(self, key, output_format):
+        return os.path.join(self.store_dir, key[:2], key + '.' + output_format)
+
+    def get(self, key, output_format, dest):
+        """
+        Materialise the object key at dest if the store contains it
+        :return: sha256 of the object or None if the store does not contain it
+        """
+        path = self.path(key, output_format)
+        try:
+            with open(path + '.sha256', 'r') as file:
+                sha256 = file.read().strip()
+            link_file(src=path, dest=dest, mode='hardlink')
+        except OSError:  # not stored (or evicted in the meantime)
+            return None
+        os.utime(path + '.sha256')
+        return sha256
+
+    def put(self, key, output_format, src, sha256):
+        """
+        Add the file src as object key to the store
+        :return: amount of bytes that were added to the store
+        """
+        path = self.path(key, output_format)
+        if os.path.exists(path + '.sha256'):
+            return 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        link_file(src=src, dest=path, mode='hardlink')
+        atomic_write(path + '.sha256', sha256.encode())  # written last, an object without sidecar does not exist
+        return os.stat(path).st_size
+
+    def objects(self):
+        """
+        :return: list of (last use, size, path) tuples of every object in the store
+        """
+        objects = []
+        if not os.path.isdir(self.store_dir):
+            return objects
+        for sub_dir in os.scandir(self.store_dir):
+            if not sub_dir.is_dir():
+                continue
+            for entry in os.scandir(sub_dir.path):
+                if not entry.name.endswith('.sha256'):
+                    continue
+                path = entry.path[:-len('.sha256')]
+                try:
+                    objects.append((entry.stat().st_mtime_ns, os.stat(path).st_size, path))
+                except OSError:
+                    continue
+        return objects
+
+    def add_size(self, size):
+        """
+        Account for size new bytes and evict the least recently used objects if the store exceeds its size limit
+        """
+        if self.size_limit is None:
+            return
+        if self.size is None:
+            self.size = sum([obj[1] for obj in self.objects()])
+        else:
+            self.size += size
+        if self.size > self.size_limit:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used objects until the store does not exceed its size limit anymore
+        """
+        objects = sorted(self.objects())
+        self.size = sum([obj[1] for obj in objects])
+        for last_use, size, path in objects:
+            if self.size_limit is None or self.size <= self.size_limit:
+                break
+            remove_file(path + '.sha256')
+            remove_file(path)
+            self.size -= size
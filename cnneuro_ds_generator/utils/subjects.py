@@ -0,0 +1,89 @@
+from cnneuro_ds_generator.utils.files import atomic_write
+import concurrent.futures
+import json
+import os
+
+INDEX_VERSION = 1
+
+
+def get_ixi_id(ixi_file):
+    """ Takes path to ixi subject and returns a string containing the ixi id """
+    return ixi_file.split('/')[-1].split('IXI')[-1][0:3]
+
+
+def __is_nifti(name):
+    return not name.startswith('.') and (name.endswith('.nii') or name.endswith('.nii.gz'))
+
+
+def __walk(directory):
+    """
+    Recursive os.scandir walk (hidden files and directories are skipped, like glob does)
+    :return: list of nifti files and dict that maps every visited directory to its modification time
+    """
+    files, dirs = [], {directory: os.stat(directory).st_mtime_ns}
+    pending = [directory]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    pending.append(entry.path)
+                    dirs[entry.path] = entry.stat().st_mtime_ns
+                elif __is_nifti(entry.name):
+                    files.append(entry.path)
+    return files, dirs
+
+
+def __load_index(input_dir, cache_file):
+    try:
+        with open(cache_file, 'r') as file:
+            index = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(index, dict) or index.get('version') != INDEX_VERSION or index.get('input_dir') != input_dir:
+        return None
+    for directory, mtime in index['dirs'].items():  # a new, removed or renamed entry changes the mtime of its directory
+        try:
+            if os.stat(directory).st_mtime_ns != mtime:
+                return None
+        except OSError:
+            return None
+    return index['subjects']
+
+
+def scan_subjects(input_dir, cache_file=None):
+    """
+    Find every nifti file (.nii and .nii.gz) below input_dir. The top-level directories are walked in parallel
+    threads. If cache_file is set, the result is stored there and reused as long as the modification time of no
+    directory below input_dir changed.
+    :param str input_dir: directory that contains the subjects
+    :param str/None cache_file: path of the index cache. None disables the cache.
+    :return: list of (ixi id, path) tuples sorted by the ixi id
+    """
+    input_dir = os.path.abspath(input_dir)
+    if cache_file is not None:
+        subjects = __load_index(input_dir, cache_file)
+        if subjects is not None:
+            return [tuple(subject) for subject in subjects]
+
+    files, dirs = [], {input_dir: os.stat(input_dir).st_mtime_ns}
+    top_dirs = []
+    with os.scandir(input_dir) as entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir():
+                top_dirs.append(entry.path)
+            elif __is_nifti(entry.name):
+                files.append(entry.path)
+    with concurrent.futures.ThreadPoolExecutor() as executor:  # the walk is I/O-bound (e.g. network filesystems)
+        for dir_files, dir_mtimes in executor.map(__walk, top_dirs):
+            files.extend(dir_files)
+            dirs.update(dir_mtimes)
+
+    subjects = sorted([(get_ixi_id(file), file) for file in files], key=lambda sub: (int(sub[0]), sub[1]))
+    if cache_file is not None:
+        index = {'version': INDEX_VERSION, 'input_dir': input_dir, 'dirs': dirs, 'subjects': subjects}
+        atomic_write(cache_file, json.dumps(index).encode())
+    return subjects
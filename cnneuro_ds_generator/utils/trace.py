@@ -0,0 +1,194 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+__trace = None  # trace into which the spans of the current process are recorded, None if nothing is recorded
+__subject = None  # subject the current process works on
+
+
+class Trace:
+    """
+    Timings of the stages (load, mask, blur, apply, lesion, compress, save, link, ...) of every subject of a run.
+    Every event is a span with its name, the subject it belongs to, the process and thread it ran in, its start (in
+    microseconds since the epoch), its duration (in microseconds) and optional arguments such as bytes_read and
+    bytes_written. Spans nest, e.g. the stages of a subject lie within its 'subject' span.
+    Pass a Trace to generate_dataset or generate_grid and export it with write_jsonl or write_chrome_trace afterwards.
+    """
+    def __init__(self):
+        self.events = []
+
+    def write_jsonl(self, path):
+        """
+        Write the events as JSON lines, one event per line
+        :param str path: destination file
+        """
+        with open(path, 'w') as file:
+            for event in self.events:
+                file.write(json.dumps(event) + '\n')
+
+    def write_chrome_trace(self, path):
+        """
+        Write the events in the trace event format of Chrome (chrome://tracing, https://ui.perfetto.dev). Every
+        process of a parallel run gets its own track.
+        :param str path: destination file
+        """
+        origin = min([event['start'] for event in self.events], default=0)
+        trace_events = []
+        for event in self.events:
+            args = dict(event['args'], subject=event['subject']) if event['subject'] is not None else event['args']
+            trace_events.append({'name': event['name'], 'cat': 'cnneuro', 'ph': 'X', 'ts': event['start'] - origin,
+                                 'dur': event['duration'], 'pid': event['pid'], 'tid': event['tid'], 'args': args})
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, file)
+
+    def totals(self, first_event=0):
+        """
+        Sum up the events per stage. The seconds of a stage are its exclusive time, i.e. without the time of the
+        spans that are nested in it, so the seconds of all stages add up to the busy time of the run.
+        :param int first_event: index of the first event that is taken into account (e.g. the first one of a run)
+        :return: dict that maps the name of every stage to a dict with its count, seconds, bytes_read and
+                 bytes_written
+        """
+        events = self.events[first_event:]
+        exclusive = [event['duration'] for event in events]
+        threads = {}
+        for index, event in enumerate(events):
+            threads.setdefault((event['pid'], event['tid']), []).append(index)
+        for indices in threads.values():
+            stack = []  # enclosing spans of the current one
+            for index in sorted(indices, key=lambda i: (events[i]['start'], -events[i]['duration'])):
+                event = events[index]
+                while stack and events[stack[-1]]['start'] + events[stack[-1]]['duration'] <= event['start']:
+                    stack.pop()
+                if stack:
+                    exclusive[stack[-1]] -= event['duration']
+                stack.append(index)
+
+        totals = {}
+        for event, duration in zip(events, exclusive):
+            total = totals.setdefault(event['name'], {'count': 0, 'seconds': 0., 'bytes_read': 0, 'bytes_written': 0})
+            total['count'] += 1
+            total['seconds'] += max(duration, 0) / 1e6
+            total['bytes_read'] += event['args'].get('bytes_read', 0)
+            total['bytes_written'] += event['args'].get('bytes_written', 0)
+        return totals
+
+
+class Progress:
+    """
+    Throughput of a run. After every subject, update is called with the events of the subject and the callback gets a
+    progress event (a dict) with:
+    subject, ill, pid (of the process that generated it), seconds, bytes_read and bytes_written of the subject and
+    done, total, elapsed (seconds since the start of the run), subjects_per_second, bytes_per_second (bytes written)
+    and eta (estimated seconds until the run is done) of the run.
+    """
+    def __init__(self, trace, callback=None):
+        """
+        :param Trace trace: trace into which the run is recorded
+        :param function/None callback: function that gets called with every progress event
+        """
+        self.trace = trace
+        self.first_event = len(trace.events)  # the trace may already contain the events of earlier runs
+        self.callback = callback
+        self.total = 0  # amount of subjects that get generated
+        self.done = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.start = time.perf_counter()
+
+    def update(self, events):
+        """
+        Account for a generated subject
+        :param list events: the events that were recorded while the subject was generated
+        """
+        read = sum([event['args'].get('bytes_read', 0) for event in events])
+        written = sum([event['args'].get('bytes_written', 0) for event in events])
+        self.done += 1
+        self.bytes_read += read
+        self.bytes_written += written
+        if self.callback is None:
+            return
+        subject = next((event for event in events if event['name'] == 'subject'), None)
+        elapsed = time.perf_counter() - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.
+        self.callback({
+            'subject': subject['args'].get('subject') if subject is not None else None,
+            'ill': subject['args'].get('ill') if subject is not None else None,
+            'pid': subject['pid'] if subject is not None else None,
+            'seconds': subject['duration'] / 1e6 if subject is not None else None,
+            'bytes_read': read, 'bytes_written': written,
+            'done': self.done, 'total': self.total, 'elapsed': elapsed, 'subjects_per_second': rate,
+            'bytes_per_second': self.bytes_written / elapsed if elapsed > 0 else 0.,
+            'eta': (self.total - self.done) / rate if rate > 0 else None
+        })
+
+    def report(self, skipped=0):
+        """
+        :param int skipped: amount of subjects that did not have to be generated (e.g. resumed ones)
+        :return: dict with the amount of generated and skipped subjects, the seconds of the run, subjects_per_second,
+                 bytes_read, bytes_written, bytes_per_second and the totals of every phase (see Trace.totals)
+        """
+        seconds = time.perf_counter() - self.start
+        return {'subjects': self.done, 'skipped': skipped, 'seconds': seconds,
+                'subjects_per_second': self.done / seconds if seconds > 0 else 0.,
+                'bytes_read': self.bytes_read, 'bytes_written': self.bytes_written,
+                'bytes_per_second': self.bytes_written / seconds if seconds > 0 else 0.,
+                'phases': self.trace.totals(self.first_event)}
+
+
+@contextlib.contextmanager
+def record(trace):
+    """
+    Record the spans of the current process into trace while the context is active
+    :param Trace/None trace: trace. None leaves the recording as it is.
+    """
+    global __trace
+    if trace is None:
+        yield
+        return
+    previous = __trace
+    __trace = trace
+    try:
+        yield
+    finally:
+        __trace = previous
+
+
+@contextlib.contextmanager
+def span(name, **args):
+    """
+    Time the enclosed block as stage name if the current process records spans (see record). The arguments become
+    the arguments of the event, the block can add more (e.g. bytes_written) to the yielded dict.
+    A 'subject' span with the argument subject sets the subject of every span that is nested in it.
+    :param str name: name of the stage
+    """
+    global __subject
+    if __trace is None:
+        yield args
+        return
+    previous_subject = __subject
+    if name == 'subject':
+        __subject = args.get('subject')
+    start = time.time_ns()
+    counter = time.perf_counter_ns()
+    try:
+        yield args
+    finally:
+        duration = time.perf_counter_ns() - counter
+        __subject = previous_subject
+        __trace.events.append({'name': name, 'subject': __subject if name != 'subject' else args.get('subject'),
+                               'pid': os.getpid(), 'tid': threading.get_native_id(), 'start': start / 1000,
+                               'duration': duration / 1000, 'args': args})
+
+
+def run_traced(func, kwargs):
+    """
+    Run func(**kwargs) and record its spans (e.g. in a worker process)
+    :return: result of func and the recorded events
+    """
+    trace = Trace()
+    with record(trace):
+        result = func(**kwargs)
+    return result, trace.events
@@ -1,5 +1,9 @@
-from cnneuro_ds_generator.utils.mri import Volume, gaussian_blur
-from cnneuro_ds_generator.utils.mask import roi_mask, concat, rand_loc_subset
+from cnneuro_ds_generator.utils.atlas import label_geometry
+from cnneuro_ds_generator.utils.mri import Volume, kernel_radii
+from cnneuro_ds_generator.utils.mask import roi_mask, atrophy_basis, atrophy_mask, basis_mask, concat, label_bases, \
+    lut_mask, rand_loc_subset, sum_bases
+from cnneuro_ds_generator.utils.trace import span
+import nibabel as nib
 import numpy as np
 
 
@@ -24,22 +28,41 @@ def __apply_offset(pos, offset_range, seed):
     return pos_x, pos_y, pos_z
 
 
-def atrophy(mri_file, atrophy_val, seed, atlas=None, loc=None ,loc_max=None, smoothing_sigma=False):
+def atrophy(mri_file, atrophy_val, seed, atlas=None, loc=None ,loc_max=None, smoothing_sigma=False,
+            mask_cache_dir=None, dtype=np.float64, mmap=False, memory_budget=None, out_file=None):
     """
     Add atrophy to mri
     :param str mri_file: volume to which atrophy should be added
     :param list/int/float loc: location(s) that should show atrophy
     :param int loc_max: if a list is passed as loc and loc_max is set, randomly between 1 and loc_max random locations
                         of this list are going to get atrophy. If loc_max is None, every specified element is used.
-    :param tuple/int/float atrophy_val: the factor with which the location(s) will be multiplied. You can pass a tuple
-                                        (min, max) and a value between min (included) and max (excluded) will be
-                                        randomly determined. You can also pass an int or float ant this value will be
-                                        used as the factor.
+    :param tuple/int/float/dict atrophy_val: the factor with which the location(s) will be multiplied. You can pass a
+                                             tuple (min, max) and a value between min (included) and max (excluded)
+                                             will be randomly determined. You can also pass an int or float ant this
+                                             value will be used as the factor. A dict maps every location to its own
+                                             factor, e.g. {41: .6, 3: .85} (loc and loc_max are not used then, see
+                                             utils.mask.lut_mask).
     :param bool/float smoothing_sigma: If not False, smoothing with given sigma is applied to the mask
     :param str atlas: path to atlas file
     :param int seed: RNG seed
+    :param str/None mask_cache_dir: directory for the on-disk cache of the blurred indicators of the locations (of
+                                    every single location with loc_max). See utils.mask.atrophy_basis.
+    :param numpy.dtype dtype: floating point type (np.float64 or np.float32) in which the volume and the mask are
+                              processed
+    :param bool mmap: If True, uncompressed volumes that are stored in dtype are read through a read-only memory map
+                      instead of being copied into memory (see utils.mri.Volume)
+    :param int/None memory_budget: If set, the volume is processed slab-wise (planes of the last axis) so that the
+                                   arrays of a slab take at most about memory_budget bytes. The volume and the atlas are
+                                   read slab by slab and the result is streamed into out_file. The masks are blurred
+                                   with an overlap of the radius of the kernel, so the result is the same as the one of
+                                   the whole volume. Integer data is written as float32.
+    :param str/None out_file: uncompressed nifti file (.nii) the result is written to. Required for memory_budget.
     :return: nifti-Image with atrophy
     """
+    if memory_budget is not None and out_file is None:
+        raise ValueError('memory_budget requires out_file!')
+    if isinstance(atrophy_val, dict) and (loc is not None or loc_max is not None or memory_budget is not None):
+        raise ValueError('An atrophy_val dict can not be combined with loc, loc_max or memory_budget!')
     if loc is not None:
         if not isinstance(loc, list) and not isinstance(loc, int) and not isinstance(loc, float):
             raise ValueError('loc must be int, float or a list!')
@@ -48,6 +71,8 @@ def atrophy(mri_file, atrophy_val, seed, atlas=None, loc=None ,loc_max=None, smo
         if isinstance(loc, int) or isinstance(loc, float):
             loc = [loc]
 
+    subject_independent = loc_max is None and not isinstance(atrophy_val, tuple)
+    labels = loc  # the subsets of loc_max are drawn from these
     if loc_max is not None:  # user wants subset of all locations
         loc = rand_loc_subset(loc=loc, loc_max=loc_max, seed=seed)  # randomly take loc_max locations
 
@@ -56,19 +81,92 @@ def atrophy(mri_file, atrophy_val, seed, atlas=None, loc=None ,loc_max=None, smo
         np.random.seed(seed)
         atrophy_val = np.random.uniform(min_val, max_val)
 
-    mri = Volume(mri_file=mri_file)
-    if loc is not None:
-        mask = roi_mask(loc=loc, val=atrophy_val, atlas_file=atlas)
-        if smoothing_sigma:
-            mask = gaussian_blur(data_arr=mask, sigma=smoothing_sigma)
-        new_data = concat(mri.data, mask)
+    mri = Volume(mri_file=mri_file, dtype=dtype, mmap=mmap)
+    if memory_budget is not None:
+        # atrophy_mask skips the blur of a mask of ones
+        smooth = smoothing_sigma and not (subject_independent and atrophy_val == 1)
+        return __atrophy_slabs(mri=mri, atrophy_val=atrophy_val, atlas=atlas, loc=loc,
+                               smoothing_sigma=smoothing_sigma if smooth else False, per_label=loc_max is not None,
+                               memory_budget=memory_budget, out_file=out_file)
+    if loc is not None or isinstance(atrophy_val, dict):
+        # the masks are patches around the ROI, only the voxels of the patch get multiplied
+        if isinstance(atrophy_val, dict):  # a factor per location, one lookup table
+            mask = lut_mask(factors=atrophy_val, atlas_file=atlas, smoothing_sigma=smoothing_sigma, dtype=dtype,
+                            sparse=True)
+        elif subject_independent:  # same mask for every subject -> reuse it
+            mask = atrophy_mask(loc=loc, val=atrophy_val, atlas_file=atlas, smoothing_sigma=smoothing_sigma,
+                                cache_dir=mask_cache_dir, dtype=dtype, sparse=True)
+        elif smoothing_sigma:  # one blur of the locations serves every atrophy_val, see atrophy_basis
+            if loc_max is not None:  # a different subset for every subject -> sum of the blurred labels
+                bases = label_bases(labels=labels, atlas_file=atlas, smoothing_sigma=smoothing_sigma,
+                                    cache_dir=mask_cache_dir, dtype=dtype)
+                basis = sum_bases(bases=bases, loc=loc)
+            else:
+                basis = atrophy_basis(loc=loc, atlas_file=atlas, smoothing_sigma=smoothing_sigma,
+                                      cache_dir=mask_cache_dir, dtype=dtype)
+            mask = basis_mask(basis=basis, val=atrophy_val, smoothing_sigma=smoothing_sigma)
+        else:
+            mask = roi_mask(loc=loc, val=atrophy_val, atlas_file=atlas, dtype=dtype, sparse=True)
+        data = mri.data
+        if not data.flags.writeable:  # read-only memory map of the file
+            data = np.array(data)
+        new_data = concat(data, mask, out=data)
     else:
-        new_data = mri.data * atrophy_val
-    return mri.create_nifti(new_data)
+        data = mri.data
+        with span('apply'):
+            new_data = np.multiply(data, atrophy_val, dtype=dtype)
+    nifti = mri.create_nifti(new_data)
+    if out_file is not None:
+        nib.save(nifti, out_file)
+    return nifti
+
+
+def __atrophy_slabs(mri, atrophy_val, atlas, loc, smoothing_sigma, per_label, memory_budget, out_file):
+    """
+    atrophy of mri, slab by slab. The blur of a plane only depends on the planes within the radius of the kernel, so
+    the blurred indicator (see atrophy_basis) of a slab is computed for the slab plus that many planes on both sides
+    (the halo), which are cut off afterwards. With per_label, the indicator is the sum of the ones of the single
+    locations like for loc_max (see sum_bases).
+    """
+    depth = mri.shape[-1]
+    halo = kernel_radii(smoothing_sigma, len(mri.shape))[-1] if loc is not None and smoothing_sigma else 0
+    # volume, mask, blurred mask and the buffers of the blur in dtype plus the atlas (float64) and its selection
+    plane_bytes = int(np.prod(mri.shape[:-1])) * (5 * mri.dtype.itemsize + 8 + 2)
+    planes = memory_budget // plane_bytes - 2 * halo
+    if planes < 1:
+        raise ValueError('memory_budget is too small, a slab needs at least %d bytes!' % ((1 + 2 * halo) * plane_bytes))
+
+    output = mri.create_nifti_file(out_file)
+    for start in range(0, depth, planes):
+        stop = min(start + planes, depth)
+        data = mri.slab(start, stop)
+        if loc is not None:
+            first, end = max(start - halo, 0), min(stop + halo, depth)
+            if smoothing_sigma:
+                if per_label:
+                    basis = sum_bases(bases={label: atrophy_basis(loc=[label], atlas_file=atlas,
+                                                                  smoothing_sigma=smoothing_sigma, dtype=mri.dtype,
+                                                                  planes=(first, end)) for label in loc}, loc=loc)
+                else:
+                    basis = atrophy_basis(loc=loc, atlas_file=atlas, smoothing_sigma=smoothing_sigma, dtype=mri.dtype,
+                                          planes=(first, end))
+                mask = np.asarray(basis_mask(basis=basis, val=atrophy_val, smoothing_sigma=smoothing_sigma))
+            else:
+                mask = roi_mask(loc=loc, val=atrophy_val, atlas_file=atlas, dtype=mri.dtype, planes=(first, end))
+            data = concat(data, mask[..., start - first:stop - first], out=data)
+        else:
+            with span('apply'):
+                data = np.multiply(data, atrophy_val, dtype=mri.dtype)
+        with span('save', file=out_file, bytes_written=data.shape[-1] * output[..., 0].nbytes):
+            output[..., start:stop] = data
+            output.flush()
+        data = mask = None  # freed before the next slab gets read
+    del output
+    return nib.load(out_file)
 
 
 def lesion(mri_file, change_prob, intensity, size, seed, size_offset=((0, 0, 0), (0, 0, 0)),
-           pos_offset=((0, 0, 0), (0, 0, 0)), loc=None, atlas=None):
+           pos_offset=((0, 0, 0), (0, 0, 0)), loc=None, atlas=None, engine='vectorized', dtype=np.float64):
     """
     Add lesion to mri
     DO NOT SET mri_file AND seed THROUGH THE END-USER-TRANSFORMER SETTINGS
@@ -89,34 +187,60 @@ def lesion(mri_file, change_prob, intensity, size, seed, size_offset=((0, 0, 0),
     :param size_offset: tuple ((min_offset_x, min_offset_y, min_offset_z), (max_offset_x, max_offset_y, max_offset_z))
     :param pos_offset: only used when in random mode. tuple ((min_offset_x, min_offset_y, min_offset_z), (max_offset_x, max_offset_y, max_offset_z))
     :param int seed: RNG seed
+    :param str engine: 'vectorized' draws the random numbers of the whole lesion at once. 'legacy' reseeds the RNG for
+                       every voxel and reproduces the output of earlier versions exactly (but is much slower). With
+                       a list of locs, the datasets pass each subject the loc order that the earlier in-place shuffle
+                       left behind (also if the transformer is a functools.partial of lesion, other wrappers with
+                       engine='legacy' in the transformer settings are rejected); called on its own, lesion never
+                       shuffles the list of the caller.
+    :param numpy.dtype dtype: floating point type (np.float64 or np.float32) in which the volume is processed
     :return:
     """
+    if engine not in ('vectorized', 'legacy'):
+        raise ValueError("engine must be either 'vectorized' or 'legacy'!")
 
     if isinstance(intensity, int):
         intensity = float(intensity)
 
-    volume = Volume(mri_file=mri_file)
+    volume = Volume(mri_file=mri_file, dtype=dtype)
     mri_data = volume.data
 
     if loc is not None:  # brain regions were specified
         if isinstance(loc, list):
             if len(loc) > 1:
+                loc = loc.copy()  # do not shuffle the list of the caller (e.g. the transformer settings)
                 np.random.seed(seed)
                 np.random.shuffle(loc)
             loc = loc[0]
-        mask = roi_mask(loc=loc, val=2, atlas_file=atlas)  # create mask where the target areas are equal to 2 and every other area 1
-        mask = mask - 1 # target areas become equal to 1 and non-target areas equal to 0
-        is_target = np.nonzero(mask)  # true-false-array where target voxels equal 1
-        # average(x), average(y), average(z)
-        axis_1 = int(np.round(np.average(is_target[0])))
-        axis_2 = int(np.round(np.average(is_target[1])))
-        axis_3 = int(np.round(np.average(is_target[2])))
-        start = (axis_1, axis_2, axis_3)
+        geometry = label_geometry(atlas)
+        if geometry is not None:  # precomputed centroid of the region
+            start = tuple([int(np.round(axis)) for axis in geometry.centroid(loc)])
+        else:  # the atlas can not be indexed
+            mask = roi_mask(loc=loc, val=2, atlas_file=atlas)  # create mask where the target areas are equal to 2 and every other area 1
+            with span('mask'):
+                mask = mask - 1 # target areas become equal to 1 and non-target areas equal to 0
+                is_target = np.nonzero(mask)  # true-false-array where target voxels equal 1
+                # average(x), average(y), average(z)
+                axis_1 = int(np.round(np.average(is_target[0])))
+                axis_2 = int(np.round(np.average(is_target[1])))
+                axis_3 = int(np.round(np.average(is_target[2])))
+                start = (axis_1, axis_2, axis_3)
     else:
         start = __apply_offset(pos=volume.mid_pos(), offset_range=pos_offset, seed=seed)
 
     size = __apply_offset(pos=size, offset_range=size_offset, seed=seed)
 
+    with span('lesion', engine=engine):
+        if engine == 'legacy':
+            __lesion_legacy(mri_data=mri_data, start=start, size=size, change_prob=change_prob, intensity=intensity,
+                            seed=seed)
+        else:
+            __lesion_vectorized(mri_data=mri_data, start=start, size=size, change_prob=change_prob,
+                                intensity=intensity, seed=seed)
+    return volume.create_nifti(mri_data)
+
+
+def __lesion_legacy(mri_data, start, size, change_prob, intensity, seed):
     x_start, y_start, z_start = start
     x_end = x_start + size[0]
     y_end = y_start + size[1]
@@ -153,4 +277,58 @@ def lesion(mri_file, change_prob, intensity, size, seed, size_offset=((0, 0, 0),
                         lower_bound=change_prob_lower_bound,
                         upper_bound=change_prob_upper_bound
                     )
-    return volume.create_nifti(mri_data)
+
+
+def __decay_schedule(val, decay_val, lower_bound, upper_bound, length):
+    """
+    Closed form of applying __apply_decay over and over again: element n is val decayed n times. Since the decay
+    stops for good as soon as one step would leave [lower_bound, upper_bound], it is val - min(n, steps) * decay_val.
+    """
+    if val < lower_bound or val > upper_bound:
+        raise ValueError('the value which should be decayed should be between lower bound and upper bound!')
+    if decay_val == 0:
+        return np.full(length, val, dtype=np.float64)
+    if decay_val > 0:
+        steps = int(np.floor((val - lower_bound) / decay_val))
+    else:
+        steps = int(np.floor((val - upper_bound) / decay_val))
+    # correct rounding errors of the division at the bounds
+    while steps > 0 and not lower_bound <= val - steps * decay_val <= upper_bound:
+        steps -= 1
+    while lower_bound <= val - (steps + 1) * decay_val <= upper_bound:
+        steps += 1
+    return val - np.minimum(np.arange(length), steps) * decay_val
+
+
+def __lesion_vectorized(mri_data, start, size, change_prob, intensity, seed):
+    """
+    Same rules as __lesion_legacy, but the random numbers of the whole lesion box are drawn at once (the RNG is seeded
+    once instead of once per voxel) and the decays are evaluated in closed form.
+    A decaying change_prob (start_val, decay, lower_bound, upper_bound) starts with start_val at the first voxel of the
+    box and decays with every voxel. A decaying intensity decays with every changed voxel.
+    """
+    x_start, y_start, z_start = start
+    index = np.ix_(np.arange(x_start, x_start + size[0] + 1),
+                   np.arange(y_start, y_start + size[1] + 1),
+                   np.arange(z_start, z_start + size[2] + 1))
+    box = np.ascontiguousarray(mri_data[index])
+
+    np.random.seed(seed)
+    draws = np.random.random(box.size)
+    if isinstance(change_prob, tuple) and len(change_prob) == 4:
+        change_prob = __decay_schedule(*change_prob, length=box.size)
+    changed = draws < change_prob
+    amount_changed = int(np.count_nonzero(changed))
+
+    if isinstance(intensity, float):
+        new_values = intensity
+    elif isinstance(intensity, tuple) and len(intensity) == 2:
+        new_values = np.random.uniform(intensity[0], intensity[1], amount_changed)
+    elif isinstance(intensity, tuple) and len(intensity) == 4:
+        new_values = __decay_schedule(*intensity, length=amount_changed)
+    else:
+        return
+
+    flat_box = box.reshape(-1)  # view in the voxel order of the legacy loop (x, y, z)
+    flat_box[changed] = new_values
+    mri_data[index] = box
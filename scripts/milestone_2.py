@@ -1,6 +1,4 @@
-from cnneuro_ds_generator.dataset import generate_dataset
-from cnneuro_ds_generator.utils.transform import atrophy
-import os
+from cnneuro_ds_generator.dataset import generate_grid
 
 INPUT_DIR = '../data_in/IXI-GM'
 ATLAS_FILE = '../data_in/atlas/AAL3v1_1mm.nii.gz'
@@ -18,27 +16,16 @@ DS_GRID = {
 
 ATROPHY_VALUES = [.35, .45, .55, .65, .75, .85, .95, 1]
 
-for key in DS_GRID.keys():
-    for index in range(len(ATROPHY_VALUES)):
-        atrophy_value = ATROPHY_VALUES[index]
-        ds_name = key + '_' + str(index+1)
-        ds_path = os.path.join(OUTPUT_DIR, ds_name)
-        print("--- Start creation of the dataset '%s' with atrophy value %s ---" % (ds_path, str(atrophy_value)))
-        TRANSFORMER = atrophy
-        TRANSFORMER_SETTINGS = {
-            'loc': DS_GRID[key],
-            'atrophy_val': atrophy_value,
-            'atlas': ATLAS_FILE,
-            'smoothing_sigma': 3.4
-        }
-
-        generate_dataset(
-            input_dir=INPUT_DIR,
-            output_dir=ds_path,
-            amount_healthy_subs=AMOUNT_HEALTHY,
-            amount_ill_subs=AMOUNT_ILL,
-            shuffle_subjects=False,
-            transformer=TRANSFORMER,
-            transformer_settings=TRANSFORMER_SETTINGS,
-            seed=SEED
-        )
+# creates the datasets Frontal_1, ..., Frontal_8, Hippocampus_1, ..., Global_8 in OUTPUT_DIR
+generate_grid(
+    input_dir=INPUT_DIR,
+    output_dir=OUTPUT_DIR,
+    amount_healthy_subs=AMOUNT_HEALTHY,
+    amount_ill_subs=AMOUNT_ILL,
+    roi_grid=DS_GRID,
+    atrophy_values=ATROPHY_VALUES,
+    atlas=ATLAS_FILE,
+    smoothing_sigma=3.4,
+    shuffle_subjects=False,
+    seed=SEED
+)
@@ -0,0 +1,54 @@
+"""
+Small synthetic inputs for the checks: IXI-like grey matter maps and a label atlas on the same grid. Everything is
+generated from a seed, no download is needed.
+"""
+from cnneuro_ds_generator.utils.atlas import clear_atlas_cache
+import nibabel as nib
+import numpy as np
+import pytest
+
+SHAPE = (23, 27, 21)
+LABELS = 12
+
+
+def write_volume(path, data):
+    """
+    :param str path: destination (.nii or .nii.gz)
+    :param numpy.ndarray data: voxel data
+    :return: path
+    """
+    nib.save(nib.Nifti1Image(data, np.diag([1.5, 1.5, 1.5, 1.])), path)
+    return str(path)
+
+
+def grey_matter(seed, shape=SHAPE):
+    """ random grey matter map (float32 values in [0, 1)) """
+    return np.random.RandomState(seed).random_sample(shape).astype(np.float32)
+
+
+def label_atlas(seed, shape=SHAPE, labels=LABELS):
+    """ every voxel gets the label (1 to labels) of the nearest of labels random centres, stored as float32 """
+    rng = np.random.RandomState(seed)
+    centres = rng.randint(0, shape, size=(labels, len(shape)))
+    grid = np.stack(np.indices(shape), axis=-1)
+    distances = ((grid[..., np.newaxis, :] - centres) ** 2).sum(axis=-1)
+    atlas = np.argmin(distances, axis=-1) + 1
+    atlas[:2] = 0  # background
+    return atlas.astype(np.float32)
+
+
+@pytest.fixture(autouse=True)
+def fresh_caches():
+    clear_atlas_cache()
+    yield
+    clear_atlas_cache()
+
+
+@pytest.fixture
+def atlas_file(tmp_path):
+    return write_volume(tmp_path / 'atlas.nii', label_atlas(seed=7))
+
+
+@pytest.fixture
+def mri_file(tmp_path):
+    return write_volume(tmp_path / 'mwp1IXI002-Guys-0828-T1.nii', grey_matter(seed=3))
@@ -0,0 +1,75 @@
+"""
+atrophy with a memory_budget processes the volume slab by slab, its output files have to be byte-identical to the
+ones of the full-volume path for every slab size.
+"""
+from cnneuro_ds_generator.dataset import generate_dataset
+from cnneuro_ds_generator.utils.mri import kernel_radii
+from cnneuro_ds_generator.utils.transform import atrophy
+from conftest import SHAPE, grey_matter, write_volume
+import numpy as np
+import os
+import pytest
+
+CONFIGS = {
+    'global': {'atrophy_val': .8},
+    'roi': {'loc': [2, 5, 9], 'atrophy_val': .55},
+    'blurred': {'loc': [2, 5, 9], 'atrophy_val': .35, 'smoothing_sigma': 1.7},
+    'wide_kernel': {'loc': [4], 'atrophy_val': .6, 'smoothing_sigma': 3.4},
+    'axis_sigmas': {'loc': [3, 11], 'atrophy_val': .5, 'smoothing_sigma': (1., 2., 1.5)},
+    'random_val': {'loc': [3, 7], 'atrophy_val': (.3, .8), 'smoothing_sigma': 1.2},
+    'loc_max': {'loc': [2, 3, 5, 7, 8, 11], 'loc_max': 3, 'atrophy_val': .4, 'smoothing_sigma': 1.2},
+    'identity': {'loc': [2, 5], 'atrophy_val': 1, 'smoothing_sigma': 1.7},
+}
+SLAB_PLANES = [1, 2, 5, SHAPE[-1]]
+
+
+def __budget(planes, settings, dtype):
+    """ memory_budget for slabs of planes planes (see the sizing of utils.transform.__atrophy_slabs) """
+    sigma = settings.get('smoothing_sigma', False)
+    halo = kernel_radii(sigma, len(SHAPE))[-1] if 'loc' in settings and sigma else 0
+    plane_bytes = SHAPE[0] * SHAPE[1] * (5 * np.dtype(dtype).itemsize + 8 + 2)
+    return (planes + 2 * halo) * plane_bytes
+
+
+def __read(path):
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+@pytest.mark.parametrize('name', sorted(CONFIGS))
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_slabs_equal_full_volume(mri_file, atlas_file, tmp_path, name, dtype):
+    settings = dict(CONFIGS[name], atlas=atlas_file, seed=4, dtype=dtype)
+    full_file = str(tmp_path / 'full.nii')
+    atrophy(mri_file=mri_file, out_file=full_file, **settings)
+    for planes in SLAB_PLANES:
+        slab_file = str(tmp_path / ('slab-%d.nii' % planes))
+        atrophy(mri_file=mri_file, out_file=slab_file, memory_budget=__budget(planes, settings, dtype), **settings)
+        assert __read(slab_file) == __read(full_file), 'slabs of %d planes' % planes
+
+
+def test_budget_too_small(mri_file, atlas_file, tmp_path):
+    with pytest.raises(ValueError):
+        atrophy(mri_file=mri_file, atrophy_val=.5, seed=0, atlas=atlas_file, loc=[2], smoothing_sigma=1.7,
+                memory_budget=__budget(1, {'loc': [2], 'smoothing_sigma': 1.7}, np.float64) - 1,
+                out_file=str(tmp_path / 'out.nii'))
+
+
+@pytest.mark.parametrize('output_format', ['nii', 'nii.gz'])
+def test_dataset_with_memory_budget(atlas_file, tmp_path, output_format):
+    input_dir = tmp_path / 'in'
+    os.makedirs(input_dir)
+    for number in range(6):  # compressed and uncompressed sources
+        write_volume(input_dir / ('mwp1IXI%03d-Guys-0828-T1.nii%s' % (number, '.gz' if number % 2 else '')),
+                     grey_matter(seed=number))
+    settings = dict(CONFIGS['blurred'], atlas=atlas_file)
+    outputs = []
+    for budget in (None, __budget(3, settings, np.float64)):
+        output_dir = str(tmp_path / ('out-%s' % budget))
+        generate_dataset(input_dir=str(input_dir), output_dir=output_dir, amount_healthy_subs=1, amount_ill_subs=5,
+                         transformer=atrophy, transformer_settings=dict(settings, memory_budget=budget), seed=42,
+                         output_format=output_format)
+        outputs.append({name: __read(os.path.join(output_dir, name)) for name in sorted(os.listdir(output_dir))
+                        if name.endswith(output_format)})
+    assert len(outputs[0]) == 6
+    assert outputs[0] == outputs[1]
@@ -0,0 +1,60 @@
+"""
+blur_mask only blurs the surroundings of the ROI, the result has to be bit-identical to blurring the whole mask.
+"""
+from cnneuro_ds_generator.utils.mask import blur_mask
+from cnneuro_ds_generator.utils.mri import GAUSSIAN_TRUNCATE
+from scipy.ndimage import gaussian_filter
+import numpy as np
+import pytest
+
+
+def __random_mask(rng, dtype):
+    shape = tuple(rng.randint(6, 40, size=rng.randint(2, 4)))
+    mask = np.ones(shape, dtype=dtype)
+    start = [rng.randint(0, edge) for edge in shape]
+    stop = [rng.randint(first + 1, edge + 1) for first, edge in zip(start, shape)]
+    box = tuple([slice(first, end) for first, end in zip(start, stop)])
+    mask[box] = np.where(rng.random_sample(mask[box].shape) < .7, rng.uniform(0, 2), 1)
+    return mask
+
+
+@pytest.mark.parametrize('seed', range(100))
+def test_blur_mask_equals_full_blur(seed):
+    rng = np.random.RandomState(seed)
+    dtype = (np.float64, np.float32)[seed % 2]
+    mask = __random_mask(rng, dtype)
+    sigma = (round(rng.uniform(.3, 4.), 2) if seed % 3 else
+             tuple([round(axis, 2) for axis in rng.uniform(.3, 4., size=mask.ndim)]))
+    expected = gaussian_filter(mask, sigma=sigma, truncate=GAUSSIAN_TRUNCATE)
+    blurred = blur_mask(mask=mask, sigma=sigma)
+    assert blurred.dtype == expected.dtype
+    assert np.array_equal(blurred, expected)
+
+
+@pytest.mark.parametrize('sigma', [1.7, 2.5, 3.4])
+def test_blur_mask_background(sigma):
+    mask = np.ones((48, 56, 44))
+    mask[20:26, 25:31, 18:22] = .4
+    expected = gaussian_filter(mask, sigma=sigma, truncate=GAUSSIAN_TRUNCATE)
+    blurred = blur_mask(mask=mask, sigma=sigma)
+    assert np.array_equal(blurred, expected)
+
+
+def test_blur_mask_background_off_by_an_ulp():
+    # the blurred ones are not exactly 1 for sigma 3.4, the background has to be that exact value
+    mask = np.ones((48, 56, 44))
+    mask[20:26, 25:31, 18:22] = .4
+    blurred = blur_mask(mask=mask, sigma=3.4)
+    assert blurred[0, 0, 0] == 1.0000000000000002
+    assert np.array_equal(blurred, gaussian_filter(mask, sigma=3.4, truncate=GAUSSIAN_TRUNCATE))
+
+
+def test_blur_mask_dtype():
+    mask = __random_mask(np.random.RandomState(0), np.float64)
+    blurred = blur_mask(mask=mask, sigma=1.3, dtype=np.float32)
+    assert np.array_equal(blurred, gaussian_filter(mask, sigma=1.3, output=np.float32, truncate=GAUSSIAN_TRUNCATE))
+
+
+def test_blur_mask_without_roi():
+    mask = np.ones((10, 12, 9), dtype=np.float32)
+    assert np.array_equal(blur_mask(mask=mask, sigma=2.), gaussian_filter(mask, sigma=2., truncate=GAUSSIAN_TRUNCATE))
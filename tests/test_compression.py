@@ -0,0 +1,61 @@
+"""
+The compression threads are shared between the worker processes, the compressed outputs do not depend on them.
+"""
+from cnneuro_ds_generator import dataset
+from cnneuro_ds_generator.dataset import generate_dataset
+from cnneuro_ds_generator.utils.files import gzip_compress
+from cnneuro_ds_generator.utils.transform import atrophy
+from conftest import grey_matter, write_volume
+import gzip
+import os
+import pytest
+
+compression_threads = getattr(dataset, '__compression_threads')
+
+
+@pytest.mark.parametrize('threads, workers, expected', [
+    (None, None, None),  # one thread per CPU in the current process
+    (None, 1, None),
+    (None, 4, 8),
+    (None, 32, 1),
+    (None, 64, 1),
+    (3, 32, 3),  # set explicitly
+])
+def test_compression_threads(monkeypatch, threads, workers, expected):
+    monkeypatch.setattr(os, 'cpu_count', lambda: 32)
+    assert compression_threads(threads, workers) == expected
+
+
+def test_invalid_compression_threads(tmp_path):
+    with pytest.raises(ValueError):
+        generate_dataset(input_dir=str(tmp_path), output_dir=str(tmp_path / 'out'), amount_healthy_subs=1,
+                         amount_ill_subs=1, transformer=atrophy, transformer_settings={'atrophy_val': .5}, seed=0,
+                         compression_threads=0)
+
+
+@pytest.mark.parametrize('threads', [1, 2, 5])
+def test_gzip_compress_independent_of_threads(monkeypatch, threads):
+    monkeypatch.setattr('cnneuro_ds_generator.utils.files.GZIP_CHUNK_SIZE', 1000)
+    data = bytes(range(256)) * 37
+    compressed = gzip_compress(data, threads=threads)
+    assert compressed == gzip_compress(data, threads=1)
+    assert gzip.decompress(compressed) == data
+
+
+def test_outputs_independent_of_workers(tmp_path):
+    input_dir = tmp_path / 'in'
+    os.makedirs(input_dir)
+    for number in range(4):
+        write_volume(input_dir / ('mwp1IXI%03d-Guys-0828-T1.nii' % number), grey_matter(seed=number))
+    outputs = []
+    for workers in (None, 2):
+        output_dir = str(tmp_path / ('out-%s' % workers))
+        generate_dataset(input_dir=str(input_dir), output_dir=output_dir, amount_healthy_subs=2, amount_ill_subs=2,
+                         transformer=atrophy, transformer_settings={'atrophy_val': .5}, seed=0, workers=workers,
+                         output_format='nii.gz')
+        outputs.append({})
+        for name in sorted(os.listdir(output_dir)):
+            if name.endswith('.nii.gz'):
+                with open(os.path.join(output_dir, name), 'rb') as file:
+                    outputs[-1][name] = file.read()
+    assert len(outputs[0]) == 4 and outputs[0] == outputs[1]
@@ -0,0 +1,49 @@
+"""
+generate_grid has to write the same datasets as generate_dataset with the atrophy transformer for every cell.
+"""
+from cnneuro_ds_generator.dataset import generate_dataset, generate_grid
+from cnneuro_ds_generator.utils.transform import atrophy
+from conftest import grey_matter, write_volume
+import os
+import pytest
+
+ROI_GRID = {'Fr': [2, 5, 9], 'Hi': 4, 'Oc': 7.0, 'Wb': None}  # lists, single locations and the whole brain
+ATROPHY_VALUES = [.35, .75, 1]
+
+
+def __read_dataset(output_dir):
+    files = {}
+    for name in sorted(os.listdir(output_dir)):
+        if name.endswith('.nii'):
+            with open(os.path.join(output_dir, name), 'rb') as file:
+                files[name] = file.read()
+    return files
+
+
+@pytest.fixture
+def input_dir(tmp_path):
+    input_dir = tmp_path / 'in'
+    os.makedirs(input_dir)
+    for number in range(5):
+        write_volume(input_dir / ('mwp1IXI%03d-Guys-0828-T1.nii' % number), grey_matter(seed=number))
+    return str(input_dir)
+
+
+@pytest.mark.parametrize('smoothing_sigma', [False, 1.7])
+@pytest.mark.parametrize('workers', [None, 2])
+def test_grid_equals_datasets(input_dir, atlas_file, tmp_path, smoothing_sigma, workers):
+    grid_dir = str(tmp_path / 'grid')
+    generate_grid(input_dir=input_dir, output_dir=grid_dir, amount_healthy_subs=2, amount_ill_subs=3,
+                  roi_grid=ROI_GRID, atrophy_values=ATROPHY_VALUES, atlas=atlas_file, seed=42,
+                  smoothing_sigma=smoothing_sigma, workers=workers)
+    for key, loc in ROI_GRID.items():
+        for index, atrophy_val in enumerate(ATROPHY_VALUES):
+            settings = {'atrophy_val': atrophy_val, 'atlas': atlas_file, 'smoothing_sigma': smoothing_sigma}
+            if loc is not None:
+                settings['loc'] = loc
+            output_dir = str(tmp_path / ('%s_%d' % (key, index + 1)))
+            generate_dataset(input_dir=input_dir, output_dir=output_dir, amount_healthy_subs=2, amount_ill_subs=3,
+                             transformer=atrophy, transformer_settings=settings, seed=42)
+            expected = __read_dataset(output_dir)
+            assert len(expected) == 5
+            assert __read_dataset(os.path.join(grid_dir, '%s_%d' % (key, index + 1))) == expected, (key, atrophy_val)
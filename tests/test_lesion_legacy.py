@@ -0,0 +1,129 @@
+"""
+lesion(engine='legacy') has to reproduce the lesions of earlier versions exactly, also the order in which a dataset
+draws the locations of a list (earlier versions shuffled that list in place, one subject after the other).
+"""
+from cnneuro_ds_generator.dataset import generate_dataset
+from cnneuro_ds_generator.utils.transform import lesion
+from conftest import grey_matter, write_volume
+import functools
+import nibabel as nib
+import numpy as np
+import os
+import pandas as pd
+import pytest
+
+
+def __decay(val, decay_val, lower_bound, upper_bound):
+    if val < lower_bound or val > upper_bound:
+        raise ValueError('the value which should be decayed should be between lower bound and upper bound!')
+    x = val - decay_val
+    return x if lower_bound <= x <= upper_bound else val
+
+
+def __offset(pos, offset_range, seed):
+    np.random.seed(seed)
+    return tuple([axis + np.random.randint(low, high + 1) for axis, low, high in zip(pos, *offset_range)])
+
+
+def __reference_lesion(mri_file, change_prob, intensity, size, seed, size_offset=((0, 0, 0), (0, 0, 0)),
+                       pos_offset=((0, 0, 0), (0, 0, 0)), loc=None, atlas=None):
+    """ the per-voxel loop of the original lesion transformer, it shuffles a list of locations in place """
+    if isinstance(intensity, int):
+        intensity = float(intensity)
+    mri_data = nib.load(mri_file).get_fdata()
+    if loc is not None:
+        if isinstance(loc, list):
+            if len(loc) > 1:
+                np.random.seed(seed)
+                np.random.shuffle(loc)
+            loc = loc[0]
+        is_target = np.nonzero(np.isin(nib.load(atlas).get_fdata(), [loc]))
+        start = tuple([int(np.round(np.average(axis))) for axis in is_target])
+    else:
+        start = __offset(pos=tuple([(edge - 1) // 2 for edge in mri_data.shape]), offset_range=pos_offset, seed=seed)
+    size = __offset(pos=size, offset_range=size_offset, seed=seed)
+
+    current_seed = seed
+    if isinstance(intensity, tuple) and len(intensity) == 4:
+        intensity_val, intensity_decay, intensity_lower_bound, intensity_upper_bound = intensity
+    for x_index in range(start[0], start[0] + size[0] + 1):
+        for y_index in range(start[1], start[1] + size[1] + 1):
+            for z_index in range(start[2], start[2] + size[2] + 1):
+                np.random.seed(current_seed)
+                current_seed += 1
+                if np.random.random() < change_prob:
+                    if isinstance(intensity, float):
+                        mri_data[x_index, y_index, z_index] = intensity
+                    elif isinstance(intensity, tuple) and len(intensity) == 2:
+                        mri_data[x_index, y_index, z_index] = np.random.uniform(intensity[0], intensity[1])
+                    elif isinstance(intensity, tuple) and len(intensity) == 4:
+                        mri_data[x_index, y_index, z_index] = intensity_val
+                        intensity_val = __decay(intensity_val, intensity_decay, intensity_lower_bound,
+                                                intensity_upper_bound)
+    return mri_data
+
+
+CONFIGS = {  # the lesions of the locations stay inside of the volume of conftest
+    'fixed': {'change_prob': .6, 'intensity': .9, 'size': (5, 6, 4), 'pos_offset': ((-3, -3, -3), (3, 3, 3))},
+    'int_intensity': {'change_prob': .4, 'intensity': 1, 'size': (3, 3, 3)},
+    'range': {'change_prob': .5, 'intensity': (.2, .6), 'size': (3, 4, 5), 'loc': 4},
+    'decay': {'change_prob': .7, 'intensity': (1., .01, .2, 1.), 'size': (3, 3, 3), 'loc': [4, 5],
+              'size_offset': ((0, 0, 0), (2, 2, 2))},
+    'loc_list': {'change_prob': .8, 'intensity': .3, 'size': (2, 3, 2), 'loc': [3, 4, 5, 7, 11]},
+}
+
+
+@pytest.mark.parametrize('name', sorted(CONFIGS))
+@pytest.mark.parametrize('seed', [0, 3, 17])
+def test_legacy_engine_equals_reference(mri_file, atlas_file, name, seed):
+    settings = dict(CONFIGS[name], atlas=atlas_file)
+    loc = settings.get('loc')
+    reference_loc = list(loc) if isinstance(loc, list) else loc  # shuffled in place by the reference
+    expected = __reference_lesion(mri_file=mri_file, seed=seed, **dict(settings, loc=reference_loc))
+    result = lesion(mri_file=mri_file, seed=seed, engine='legacy', **settings)
+    assert np.array_equal(np.asarray(result.dataobj), expected)
+    assert settings.get('loc') == CONFIGS[name].get('loc')  # lesion does not shuffle the list of the caller
+
+
+def wrapped_lesion(mri_file, seed, **settings):
+    return lesion(mri_file=mri_file, seed=seed, **settings)
+
+
+@pytest.fixture
+def input_dir(tmp_path):
+    input_dir = tmp_path / 'in'
+    os.makedirs(input_dir)
+    for number in range(8):
+        write_volume(input_dir / ('mwp1IXI%03d-Guys-0828-T1.nii' % number), grey_matter(seed=number))
+    return input_dir
+
+
+@pytest.mark.parametrize('wrapping', ['none', 'partial', 'nested_partial'])
+@pytest.mark.parametrize('workers', [None, 3])
+def test_legacy_dataset_keeps_shuffle_chain(input_dir, atlas_file, tmp_path, workers, wrapping):
+    settings = dict(CONFIGS['loc_list'], atlas=atlas_file)
+    if wrapping == 'none':
+        transformer, transformer_settings = lesion, dict(settings, engine='legacy')
+    elif wrapping == 'partial':
+        transformer, transformer_settings = functools.partial(lesion, engine='legacy'), settings
+    else:  # the locations are bound by the inner partial
+        transformer = functools.partial(functools.partial(lesion, loc=settings['loc']), engine='legacy')
+        transformer_settings = {key: value for key, value in settings.items() if key != 'loc'}
+    output_dir = str(tmp_path / 'out')
+    generate_dataset(input_dir=str(input_dir), output_dir=output_dir, amount_healthy_subs=2, amount_ill_subs=6,
+                     transformer=transformer, transformer_settings=transformer_settings, seed=3, workers=workers)
+
+    demographic = pd.read_csv(os.path.join(output_dir, 'demographic.csv'), dtype={'id': str})
+    shared_loc = list(settings['loc'])  # the original loop passed the same list to every subject, in this order
+    for index, subject_id in enumerate(demographic['id'][demographic['ill'] == 1]):
+        expected = __reference_lesion(mri_file=str(input_dir / ('mwp1IXI%s-Guys-0828-T1.nii' % subject_id)),
+                                      seed=3 + index, **dict(settings, loc=shared_loc))
+        result = np.asarray(nib.load(os.path.join(output_dir, 'sub-%s-ill.nii' % subject_id)).dataobj)
+        assert np.array_equal(result, expected.astype(result.dtype)), 'subject %s' % subject_id
+
+
+def test_legacy_dataset_rejects_unknown_wrapper(input_dir, atlas_file, tmp_path):
+    settings = dict(CONFIGS['loc_list'], atlas=atlas_file, engine='legacy')
+    with pytest.raises(ValueError):
+        generate_dataset(input_dir=str(input_dir), output_dir=str(tmp_path / 'out'), amount_healthy_subs=2,
+                         amount_ill_subs=6, transformer=wrapped_lesion, transformer_settings=settings, seed=3)
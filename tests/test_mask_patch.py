@@ -0,0 +1,87 @@
+"""
+A MaskPatch has to behave exactly like the dense mask it stands for: creating, blurring and applying it. Only the
+blurred masks that are built from an atrophy_basis may differ from the blur of the dense mask, by a few ulp.
+"""
+from cnneuro_ds_generator.utils import mask as mask_module
+from cnneuro_ds_generator.utils.atlas import clear_atlas_cache
+from cnneuro_ds_generator.utils.mask import MaskPatch, atrophy_mask, blur_mask, concat, roi_mask
+from cnneuro_ds_generator.utils.mri import GAUSSIAN_TRUNCATE, Volume
+from cnneuro_ds_generator.utils.transform import atrophy
+from scipy.ndimage import gaussian_filter
+import nibabel as nib
+import numpy as np
+import pytest
+
+LOCS = [[3], [2, 5, 9], [4.0, 11], [40]]  # 40 does not occur in the atlas
+
+
+def __full_blur(mask, sigma):
+    return gaussian_filter(np.asarray(mask), sigma=sigma, truncate=GAUSSIAN_TRUNCATE)
+
+
+def __assert_blur_of(mask, expected, blurred):
+    """ masks built from an atrophy_basis differ from the blur of the value mask by a few ulp only """
+    if blurred:
+        np.testing.assert_allclose(mask, expected, rtol=0, atol=8 * np.finfo(expected.dtype).eps)
+    else:
+        assert np.array_equal(mask, expected)
+
+
+@pytest.mark.parametrize('loc', LOCS)
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_roi_mask_patch(atlas_file, loc, dtype):
+    dense = roi_mask(loc=loc, val=.3, atlas_file=atlas_file, dtype=dtype)
+    patch = roi_mask(loc=loc, val=.3, atlas_file=atlas_file, dtype=dtype, sparse=True)
+    assert isinstance(patch, MaskPatch)
+    assert patch.dtype == dense.dtype
+    assert np.array_equal(np.asarray(patch), dense)
+
+
+@pytest.mark.parametrize('loc', LOCS)
+@pytest.mark.parametrize('sigma', [1.2, 2.5, 3.4, (1., 2., 1.5)])
+def test_blur_mask_patch(atlas_file, loc, sigma):
+    patch = roi_mask(loc=loc, val=.45, atlas_file=atlas_file, sparse=True)
+    blurred = blur_mask(mask=patch, sigma=sigma)
+    assert isinstance(blurred, MaskPatch)
+    assert np.array_equal(np.asarray(blurred), __full_blur(patch, sigma))
+
+
+@pytest.mark.parametrize('sigma', [False, 1.7, 3.4])
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_atrophy_mask_patch(atlas_file, tmp_path, sigma, dtype):
+    dense = roi_mask(loc=[2, 5], val=.6, atlas_file=atlas_file, dtype=dtype)
+    expected = __full_blur(dense, sigma) if sigma else dense
+    masks = []
+    for cache_dir in (None, str(tmp_path), str(tmp_path)):  # computed, written to the cache, read from the cache
+        clear_atlas_cache()
+        getattr(mask_module, '__atrophy_mask').cache_clear()
+        getattr(mask_module, '__atrophy_basis').cache_clear()
+        masks.append(np.asarray(atrophy_mask(loc=[2, 5], val=.6, atlas_file=atlas_file, smoothing_sigma=sigma,
+                                             cache_dir=cache_dir, dtype=dtype, sparse=True)))
+    __assert_blur_of(masks[0], expected, sigma)
+    assert np.array_equal(masks[0], masks[1]) and np.array_equal(masks[0], masks[2])
+
+
+@pytest.mark.parametrize('background', [1., 1.0000000000000002, .5])
+def test_concat_patch(mri_file, background):
+    data = Volume(mri_file).data
+    block = np.random.RandomState(1).random_sample((4, 6, 5))
+    patch = MaskPatch(shape=data.shape, box=(slice(3, 7), slice(10, 16), slice(0, 5)), block=block,
+                      background=background)
+    expected = np.multiply(data, np.asarray(patch))
+    assert np.array_equal(concat(data, patch), expected)
+    in_place = data.copy()
+    assert concat(in_place, patch, out=in_place) is in_place
+    assert np.array_equal(in_place, expected)
+
+
+@pytest.mark.parametrize('sigma', [False, 1.7, 3.4])
+@pytest.mark.parametrize('mmap', [False, True])
+def test_atrophy_patch(mri_file, atlas_file, sigma, mmap):
+    data = nib.load(mri_file).get_fdata(dtype=np.float32)
+    mask = roi_mask(loc=[3, 8], val=.7, atlas_file=atlas_file, dtype=np.float32)
+    expected = data * (__full_blur(mask, sigma) if sigma else mask)
+    result = atrophy(mri_file=mri_file, atrophy_val=.7, seed=0, atlas=atlas_file, loc=[3, 8], smoothing_sigma=sigma,
+                     dtype=np.float32, mmap=mmap)
+    __assert_blur_of(np.asarray(result.dataobj), expected, sigma)
+    assert np.array_equal(nib.load(mri_file).get_fdata(dtype=np.float32), data)  # the source stays untouched
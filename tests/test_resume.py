@@ -0,0 +1,126 @@
+"""
+generate_dataset(resume=True) skips the subjects whose manifest entry and output are unchanged, generates the others
+and removes the outputs of subjects that are not part of the dataset anymore. The result has to be the dataset of a
+fresh run.
+"""
+from cnneuro_ds_generator.dataset import generate_dataset
+from cnneuro_ds_generator.utils.manifest import MANIFEST_FILE, MANIFEST_JOURNAL, load_manifest
+from cnneuro_ds_generator.utils.subjects import get_ixi_id
+from cnneuro_ds_generator.utils.trace import Trace
+from cnneuro_ds_generator.utils.transform import atrophy
+from conftest import grey_matter, write_volume
+import os
+import pytest
+
+SETTINGS = {'atrophy_val': .6}
+FAILING_SUBJECTS = set()
+
+
+def failing_atrophy(mri_file, seed, **settings):
+    """ atrophy that fails for the subjects in FAILING_SUBJECTS, like a run that crashes """
+    if get_ixi_id(mri_file) in FAILING_SUBJECTS:
+        raise RuntimeError('Subject %s failed!' % get_ixi_id(mri_file))
+    return atrophy(mri_file=mri_file, seed=seed, **settings)
+
+
+def __outputs(output_dir):
+    outputs = {}
+    for name in sorted(os.listdir(output_dir)):
+        if name.startswith('sub-'):
+            with open(os.path.join(output_dir, name), 'rb') as file:
+                outputs[name] = file.read()
+    return outputs
+
+
+def __mtimes(output_dir):
+    return {name: os.stat(os.path.join(output_dir, name)).st_mtime_ns for name in os.listdir(output_dir)
+            if name.startswith('sub-')}
+
+
+@pytest.fixture
+def input_dir(tmp_path):
+    input_dir = tmp_path / 'in'
+    os.makedirs(input_dir)
+    for number in range(10):
+        write_volume(input_dir / ('mwp1IXI%03d-Guys-0828-T1.nii' % number), grey_matter(seed=number))
+    return str(input_dir)
+
+
+@pytest.fixture
+def generate(input_dir, tmp_path):
+    def generate(name, amount_healthy_subs=3, amount_ill_subs=4, transformer=atrophy, settings=SETTINGS, **kwargs):
+        output_dir = str(tmp_path / name)
+        report = generate_dataset(input_dir=input_dir, output_dir=output_dir, amount_healthy_subs=amount_healthy_subs,
+                                  amount_ill_subs=amount_ill_subs, transformer=transformer,
+                                  transformer_settings=settings, seed=42, **kwargs)
+        return output_dir, report
+    return generate
+
+
+def test_resume_skips_unchanged(generate):
+    output_dir, report = generate('out', resume=True)
+    assert report['subjects'] == 7 and report['skipped'] == 0
+    mtimes = __mtimes(output_dir)
+    output_dir, report = generate('out', resume=True)
+    assert report['subjects'] == 0 and report['skipped'] == 7
+    assert __mtimes(output_dir) == mtimes
+    assert not os.path.exists(os.path.join(output_dir, MANIFEST_JOURNAL))
+
+
+def test_resume_regenerates_stale(generate):
+    output_dir, _ = generate('out', resume=True)
+    expected = __outputs(output_dir)
+    with open(os.path.join(output_dir, 'sub-000-ill.nii'), 'r+b') as file:  # changed output
+        file.seek(-4, os.SEEK_END)
+        file.write(b'\0\0\0\0')
+    os.remove(os.path.join(output_dir, 'sub-005-healthy.nii'))  # missing output
+    _, report = generate('out', resume=True)
+    assert report['subjects'] == 2 and report['skipped'] == 5
+    assert __outputs(output_dir) == expected
+
+
+def test_resume_regenerates_changed_settings(generate):
+    output_dir, _ = generate('out', resume=True)
+    _, report = generate('out', settings={'atrophy_val': .7}, resume=True)
+    assert report['subjects'] == 4 and report['skipped'] == 3  # the healthy subjects stay the same
+    assert __outputs(output_dir) == __outputs(generate('fresh', settings={'atrophy_val': .7})[0])
+
+
+@pytest.mark.parametrize('amounts', [(2, 3), (5, 4)])  # shrink and grow the dataset
+def test_resume_changed_subjects(generate, amounts):
+    output_dir, _ = generate('out', resume=True)
+    amount_healthy_subs, amount_ill_subs = amounts
+    _, report = generate('out', amount_healthy_subs=amount_healthy_subs, amount_ill_subs=amount_ill_subs,
+                         resume=True)
+    fresh_dir, _ = generate('fresh', amount_healthy_subs=amount_healthy_subs, amount_ill_subs=amount_ill_subs)
+    assert __outputs(output_dir) == __outputs(fresh_dir)  # the outputs of dropped subjects are removed
+    assert sorted(load_manifest(output_dir)) == sorted(__outputs(fresh_dir))
+
+
+def test_resume_after_crash(generate, tmp_path):
+    FAILING_SUBJECTS.add('002')  # the third ill subject
+    try:
+        with pytest.raises(RuntimeError):
+            generate('out', transformer=failing_atrophy, resume=True)
+    finally:
+        FAILING_SUBJECTS.clear()
+    output_dir = str(tmp_path / 'out')
+    assert os.path.exists(os.path.join(output_dir, MANIFEST_JOURNAL))  # the finished subjects are journaled
+    assert sorted(load_manifest(output_dir)) == ['sub-000-ill.nii', 'sub-001-ill.nii']
+    with open(os.path.join(output_dir, MANIFEST_JOURNAL), 'a') as file:
+        file.write('{"name": "sub-003-ill.nii", "ent')  # crashed while appending
+    _, report = generate('out', transformer=failing_atrophy, resume=True)
+    assert report['subjects'] == 5 and report['skipped'] == 2
+    assert __outputs(output_dir) == __outputs(generate('fresh', transformer=failing_atrophy)[0])
+    assert os.path.exists(os.path.join(output_dir, MANIFEST_FILE))
+    assert not os.path.exists(os.path.join(output_dir, MANIFEST_JOURNAL))
+
+
+def test_linked_healthy_outputs_are_not_read(generate):
+    trace = Trace()
+    output_dir, _ = generate('out', healthy_mode='hardlink', trace=trace)
+    assert not [event for event in trace.events if event.get('name') == 'hash']
+    healthy = [entry for entry in load_manifest(output_dir).values() if not entry['ill']]
+    assert len(healthy) == 3 and all(['source' in entry['output'] for entry in healthy])
+    _, report = generate('out', healthy_mode='hardlink', resume=True)
+    assert report['skipped'] == 7